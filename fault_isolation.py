@@ -0,0 +1,175 @@
+"""
+Fault Isolation Module
+---------------------
+
+Description:
+This file contains code for isolating the processing of each scan: the scans can be processed in a worker
+process with a timeout, failed attempts are retried, and the scans that still fail are copied to a dead-letter
+directory and logged in an error file, so that one bad file does not abort the whole batch.
+
+Authors: LE GOURRIEREC Titouan, CONNESSON Léna, PROUVOST Axel
+Date: 04/06/2024
+"""
+
+import csv
+import multiprocessing
+import os
+import shutil
+import time
+
+########################################################################################################
+############################           Parameters & Constants              #############################
+########################################################################################################
+
+# Maximum time in seconds to process one scan in the worker process (None to process the scans in the main
+# process, without timeout)
+SCAN_TIMEOUT = 600.0
+
+# Number of retries of a failed scan, and delay in seconds before each retry
+MAX_RETRIES = 1
+RETRY_DELAY = 1.0
+
+DEAD_LETTER_DIR = 'Dead_Letter'
+ERRORS_FILE = 'errors.csv'
+ERRORS_COLUMNS = ['Original_File_Name', 'Attempt', 'Error', 'Message']
+
+########################################################################################################
+############################                 Main Functions                 #############################
+########################################################################################################
+
+class ScanTimeoutError(Exception):
+    """Raised when the processing of a scan exceeds its timeout."""
+
+
+class IsolatedRunner:
+    """
+    Runs functions in a worker process, with a timeout.
+
+    The worker process is kept between the calls (so that, e.g., the OCR models are loaded only once), and is
+    replaced when a call times out. The functions and their arguments must be picklable.
+
+    Usage:
+        with IsolatedRunner() as runner:
+            result = runner.run(function, args, timeout=600)
+    """
+
+    def __init__(self) -> None:
+        self._context = multiprocessing.get_context('spawn')
+        self._pool = None
+
+    def run(self,
+            function: callable,
+            args: tuple,
+            timeout: float = None):
+        """
+        Runs a function in the worker process.
+
+        Parameters:
+            - function (callable): The function to run, defined at the top level of a module.
+            - args (tuple): The arguments of the function.
+            - timeout (float, optional): The maximum time in seconds. Defaults to None (no timeout).
+
+        Returns:
+            - The result of the function. The exceptions raised by the function are raised again, and a
+              ScanTimeoutError is raised if the function does not return in time.
+        """
+        if self._pool is None:
+            self._pool = self._context.Pool(processes=1)
+
+        async_result = self._pool.apply_async(function, args)
+        try:
+            return async_result.get(timeout)
+        except multiprocessing.TimeoutError:
+            # The worker may be stuck, so it is killed and replaced at the next call
+            self.close()
+            raise ScanTimeoutError(f"Timeout after {timeout}s.")
+
+    def close(self) -> None:
+        """Kill the worker process."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self) -> 'IsolatedRunner':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def run_with_retries(function: callable,
+                     args: tuple,
+                     max_retries: int = MAX_RETRIES,
+                     runner: IsolatedRunner = None,
+                     timeout: float = None,
+                     on_failure: callable = None,
+                     retry_delay: float = RETRY_DELAY) -> tuple:
+    """
+    Runs a function, retrying it when it fails.
+
+    Parameters:
+        - function (callable): The function to run.
+        - args (tuple): The arguments of the function.
+        - max_retries (int, optional): The number of retries after the first attempt. Defaults to MAX_RETRIES.
+        - runner (IsolatedRunner, optional): If given, the function is run in its worker process with the timeout.
+                                             Defaults to None (the function is run in the current process).
+        - timeout (float, optional): The timeout of each attempt when a runner is given. Defaults to None.
+        - on_failure (callable, optional): A function called with (attempt, error) after each failed attempt,
+                                           e.g. to clean the partial outputs. Defaults to None.
+        - retry_delay (float, optional): The delay in seconds before each retry. Defaults to RETRY_DELAY.
+
+    Returns:
+        - tuple: The result of the function and None if an attempt succeeded, or None and the list of the
+                 errors of the attempts if they all failed.
+    """
+    errors = []
+    for attempt in range(1, max_retries + 2):
+        if attempt > 1:
+            time.sleep(retry_delay)
+        try:
+            if runner is None:
+                return function(*args), None
+            return runner.run(function, args, timeout), None
+
+        except Exception as error:
+            errors.append(error)
+            if callable(on_failure):
+                on_failure(attempt, error)
+
+    return None, errors
+
+
+def log_error(errors_path: str,
+              filename: str,
+              attempt: int,
+              error: Exception) -> None:
+    """
+    Appends the error of an attempt to the error file.
+
+    Parameters:
+        - errors_path (str): The path to the error file (CSV).
+        - filename (str): The name of the scan.
+        - attempt (int): The number of the attempt.
+        - error (Exception): The error.
+    """
+    new_file = not os.path.exists(errors_path)
+    with open(errors_path, 'a', newline='') as file:
+        writer = csv.writer(file)
+        if new_file:
+            writer.writerow(ERRORS_COLUMNS)
+        writer.writerow([filename, attempt, type(error).__name__, str(error)])
+
+
+def dead_letter(full_path: str,
+                dead_letter_path: str) -> None:
+    """
+    Copies a scan that could not be processed to the dead-letter directory, from which it can be processed
+    again by using this directory as input directory.
+
+    Parameters:
+        - full_path (str): The path to the scan.
+        - dead_letter_path (str): The path to the dead-letter directory.
+    """
+    os.makedirs(dead_letter_path, exist_ok=True)
+    shutil.copy2(full_path, os.path.join(dead_letter_path, os.path.basename(full_path)))
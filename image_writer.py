@@ -0,0 +1,249 @@
+"""
+Image Writer Module
+---------------------
+
+Description:
+This file contains the write-behind image writer. The images are put in a bounded queue and encoded and written
+by a pool of threads, so that the encoding of the outputs overlaps with the processing of the next scan
+without an unbounded growth of the memory.
+
+Authors: LE GOURRIEREC Titouan, CONNESSON Léna, PROUVOST Axel
+Date: 04/06/2024
+"""
+
+import os
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+########################################################################################################
+############################           Parameters & Constants              #############################
+########################################################################################################
+
+# Maximum number of images waiting to be encoded. The pending leaf crops are views of their scan, so this
+# bounds the number of scans kept in memory by the writer.
+MAX_PENDING_IMAGES = 8
+
+# Number of encoding threads (OpenCV releases the GIL while encoding)
+ENCODER_THREADS = 4
+
+# Whether to flush the written files to the disk
+FSYNC = True
+
+########################################################################################################
+############################                 Main Functions                 #############################
+########################################################################################################
+
+class ImageWriter:
+    """
+    Encodes and writes images in a pool of threads, fed by a bounded queue.
+
+    `write` blocks when MAX_PENDING_IMAGES images are waiting, and raises the first error encountered by the
+    encoding threads. `flush` waits until all the queued images are written.
+
+    The images can be tagged, e.g. with the scan they belong to. The errors of the tagged images are not raised
+    by `write`, `flush` and `close` but by `settle`, which waits only for the images of its tag, so that a failed
+    image can be attributed to its scan while the next scans are processed.
+
+    Usage:
+        writer = ImageWriter()
+        writer.write(path, image, tag=1)
+        ...
+        writer.settle(1)  # raises the first error of the images tagged 1
+        writer.close()  # flush barrier, e.g. before reading the images back
+        print(writer.metrics())
+    """
+
+    def __init__(self,
+                 max_pending: int = MAX_PENDING_IMAGES,
+                 workers: int = ENCODER_THREADS,
+                 fsync: bool = FSYNC) -> None:
+        """
+        Parameters:
+            - max_pending (int, optional): The maximum number of images waiting to be encoded. Defaults to MAX_PENDING_IMAGES.
+            - workers (int, optional): The number of encoding threads. Defaults to ENCODER_THREADS.
+            - fsync (bool, optional): Whether to flush the written files to the disk. Defaults to FSYNC.
+        """
+        self.fsync = fsync
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Condition()
+        self._error = None
+        self._closed = False
+        self._tags = {} # tag -> number of pending images, first error and metrics of the images of the tag
+
+        # Metrics
+        self._images = 0
+        self._bytes = 0
+        self._encode_time = 0.0
+        self._max_queue_depth = 0
+
+        self._threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def write(self,
+              path: str,
+              image: np.ndarray,
+              parameters: list[int] = None,
+              tag: object = None) -> None:
+        """
+        Queues an image for writing. The format is given by the extension of the path.
+
+        Parameters:
+            - path (str): The path of the file to write.
+            - image (numpy.ndarray): The image to write. It must not be modified until it is written.
+            - parameters (list, optional): The OpenCV encoding parameters. Defaults to None.
+            - tag (hashable, optional): The tag of the image, whose error is then raised by `settle`. Defaults to None.
+        """
+        if self._closed:
+            raise RuntimeError("The image writer is closed.")
+        self._raise_error()
+
+        if tag is not None:
+            with self._lock:
+                state = self._tags.setdefault(tag, {'pending': 0, 'error': None, 'images': 0, 'bytes': 0, 'encode_time': 0.0})
+                state['pending'] += 1
+
+        self._queue.put((path, image, parameters or [], tag))
+        with self._lock:
+            self._max_queue_depth = max(self._max_queue_depth, self._queue.qsize())
+
+    def flush(self) -> None:
+        """Wait until all the queued images are written, raising the first error encountered."""
+        self._queue.join()
+        self._raise_error()
+
+    def settle(self,
+               tag: object) -> dict:
+        """
+        Waits until all the images of a tag are written, raising the first error encountered on them.
+
+        Parameters:
+            - tag (hashable): The tag of the images.
+
+        Returns:
+            - dict: The number of images and bytes written and the time spent encoding and writing them.
+        """
+        with self._lock:
+            self._lock.wait_for(lambda: tag not in self._tags or self._tags[tag]['pending'] == 0)
+            state = self._tags.pop(tag, {'error': None, 'images': 0, 'bytes': 0, 'encode_time': 0.0})
+
+        if state['error'] is not None:
+            raise state['error']
+        return {'images': state['images'], 'bytes': state['bytes'], 'encode_time': state['encode_time']}
+
+    def add_metrics(self,
+                    metrics: dict) -> None:
+        """
+        Adds the metrics of images written by another writer, e.g. in a worker process.
+
+        Parameters:
+            - metrics (dict): The number of images and bytes written and the time spent encoding and writing them.
+        """
+        with self._lock:
+            self._images += metrics['images']
+            self._bytes += metrics['bytes']
+            self._encode_time += metrics['encode_time']
+
+    def close(self) -> None:
+        """Flush the queued images and stop the encoding threads."""
+        if self._closed:
+            return
+        self._closed = True
+
+        self._queue.join()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+        self._raise_error()
+
+    def metrics(self) -> dict:
+        """
+        Returns the metrics of the writer.
+
+        Returns:
+            - dict: The number of images and bytes written, the time spent encoding and writing (summed over the
+                    threads), the encode throughput in images and megabytes per second of encoding time (i.e. per
+                    encoding thread), and the maximum depth reached by the queue.
+        """
+        with self._lock:
+            encode_time = max(self._encode_time, 1e-9)
+            return {
+                'images': self._images,
+                'bytes': self._bytes,
+                'encode_time': round(self._encode_time, 3),
+                'images_per_second': round(self._images / encode_time, 2),
+                'megabytes_per_second': round(self._bytes / encode_time / 1e6, 2),
+                'max_queue_depth': self._max_queue_depth,
+            }
+
+    def _worker(self) -> None:
+        """Encode and write the queued images until the stop sentinel is received."""
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+
+                path, image, parameters, tag = item
+                start = time.time()
+                size = _encode_and_write(path, image, parameters, self.fsync)
+                encode_time = time.time() - start
+
+                with self._lock:
+                    self._images += 1
+                    self._bytes += size
+                    self._encode_time += encode_time
+                    if tag is not None:
+                        state = self._tags[tag]
+                        state['images'] += 1
+                        state['bytes'] += size
+                        state['encode_time'] += encode_time
+
+            except Exception as error:
+                with self._lock:
+                    if tag is None and self._error is None:
+                        self._error = error
+                    elif tag is not None and self._tags[tag]['error'] is None:
+                        self._tags[tag]['error'] = error
+
+            finally:
+                if item is not None and tag is not None:
+                    with self._lock:
+                        self._tags[tag]['pending'] -= 1
+                        self._lock.notify_all()
+                self._queue.task_done()
+
+    def _raise_error(self) -> None:
+        """Raise the first error encountered by the encoding threads."""
+        with self._lock:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+########################################################################################################
+############################           Helper Functions                    #############################
+########################################################################################################
+
+def _encode_and_write(path: str,
+                      image: np.ndarray,
+                      parameters: list[int],
+                      fsync: bool) -> int:
+    """Encode an image according to the extension of the path and write it, returning its size in bytes."""
+    success, buffer = cv2.imencode(os.path.splitext(path)[1], image, parameters)
+    if not success:
+        raise IOError(f"Could not encode the image {path}.")
+
+    with open(path, 'wb') as file:
+        file.write(buffer)
+        if fsync:
+            file.flush()
+            os.fsync(file.fileno())
+
+    return buffer.size
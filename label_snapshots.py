@@ -0,0 +1,218 @@
+"""
+Label Snapshots Module
+---------------------
+
+Description:
+This file contains code for saving the snapshots of the labels. The snapshots are encoded and written by the
+write-behind image writer in a configurable format and quality, and can also be gathered into contact sheets
+for a quick visual check of the OCR results.
+
+Authors: LE GOURRIEREC Titouan, CONNESSON Léna, PROUVOST Axel
+Date: 04/06/2024
+"""
+
+import os
+
+import cv2
+import numpy as np
+
+from image_writer import ImageWriter
+
+########################################################################################################
+############################           Parameters & Constants              #############################
+########################################################################################################
+
+# Format and quality of the label snapshots
+LABEL_FORMAT = '.jpg'
+LABEL_FORMATS = ['.jpg', '.jpeg', '.png', '.webp']
+LABEL_QUALITY = 90
+
+# Layout of the contact sheets
+CONTACT_SHEET_COLUMNS = 8
+CONTACT_SHEET_ROWS = 8
+CONTACT_SHEET_CELL_SIZE = (256, 128) # (width, height) of each snapshot in the contact sheet
+CONTACT_SHEET_NAME = 'Labels_contact_sheet_{index}'
+
+########################################################################################################
+############################                 Main Functions                 #############################
+########################################################################################################
+
+def encoding_parameters(image_format: str,
+                        quality: int) -> list[int]:
+    """
+    Returns the OpenCV encoding parameters corresponding to a format and a quality.
+
+    Parameters:
+        - image_format (str): The extension of the format, e.g. '.jpg', '.png' or '.webp'.
+        - quality (int): The quality from 0 to 100. For PNG, it is converted to a compression level.
+
+    Returns:
+        - list: The parameters to pass to `cv2.imwrite` or `cv2.imencode`.
+    """
+    if not 0 <= quality <= 100:
+        raise ValueError(f"The label quality must be from 0 to 100, got {quality}.")
+    image_format = image_format.lower()
+    if image_format in ('.jpg', '.jpeg'):
+        return [cv2.IMWRITE_JPEG_QUALITY, quality]
+    if image_format == '.webp':
+        return [cv2.IMWRITE_WEBP_QUALITY, quality]
+    if image_format == '.png':
+        return [cv2.IMWRITE_PNG_COMPRESSION, round(9 - 9 * quality / 100)]
+    raise ValueError(f"Unsupported label format '{image_format}'.")
+
+
+class LabelSnapshotWriter:
+    """
+    Writes the label snapshots through an image writer.
+
+    Usage:
+        writer = LabelSnapshotWriter(image_writer, labels_path)
+        label_file = writer.write(label_index, snapshot)
+        ...
+        writer.close()  # queues the contact sheets
+        image_writer.close()
+    """
+
+    def __init__(self,
+                 image_writer: ImageWriter,
+                 labels_path: str,
+                 image_format: str = LABEL_FORMAT,
+                 quality: int = LABEL_QUALITY,
+                 contact_sheet: bool = False) -> None:
+        """
+        Parameters:
+            - image_writer (ImageWriter): The writer encoding and writing the snapshots.
+            - labels_path (str): The directory where the snapshots are saved.
+            - image_format (str, optional): The extension of the snapshots. Defaults to LABEL_FORMAT.
+            - quality (int, optional): The quality of the snapshots, from 0 to 100. Defaults to LABEL_QUALITY.
+            - contact_sheet (bool, optional): Whether to also gather the snapshots into contact sheets. Defaults to False.
+        """
+        self.labels_path = labels_path
+        self.image_format = image_format
+        self.parameters = encoding_parameters(image_format, quality)
+        self.contact_sheet = contact_sheet
+
+        self._image_writer = image_writer
+        self._thumbnails = []
+
+    def write(self,
+              label_index: int,
+              snapshot: np.ndarray) -> str:
+        """
+        Queues the snapshot of a label for writing, tagged with the index of the label.
+
+        Parameters:
+            - label_index (int): The index of the label, used in the file name.
+            - snapshot (numpy.ndarray): The snapshot of the label.
+
+        Returns:
+            - str: The file name of the snapshot.
+        """
+        file_name = f"Labels_{label_index}{self.image_format}"
+        self._image_writer.write(os.path.join(self.labels_path, file_name), snapshot, self.parameters, label_index)
+        self.add_to_contact_sheet(label_index, snapshot)
+
+        return file_name
+
+    def add_to_contact_sheet(self,
+                             label_index: int,
+                             snapshot: np.ndarray) -> None:
+        """
+        Adds the snapshot of a label to the contact sheets, e.g. for a snapshot written by another process.
+
+        Parameters:
+            - label_index (int): The index of the label, used as caption.
+            - snapshot (numpy.ndarray): The snapshot of the label.
+        """
+        if self.contact_sheet:
+            self._thumbnails.append((label_index, thumbnail(snapshot, CONTACT_SHEET_CELL_SIZE)))
+
+    def discard(self,
+                label_index: int) -> None:
+        """
+        Removes the snapshot of a label from the contact sheets, e.g. for a scan which failed.
+
+        Parameters:
+            - label_index (int): The index of the label.
+        """
+        self._thumbnails = [(index, image) for index, image in self._thumbnails if index != label_index]
+
+    def relabel(self,
+                new_labels: dict) -> None:
+        """
+        Changes the indexes of the labels in the contact sheets, e.g. when the labels are renumbered.
+
+        Parameters:
+            - new_labels (dict): The new index of each label index.
+        """
+        self._thumbnails = [(new_labels[index], image) for index, image in self._thumbnails]
+
+    def close(self) -> list[str]:
+        """
+        Queues the contact sheets for writing.
+
+        Returns:
+            - list: The file names of the contact sheets.
+        """
+        sheet_names = []
+        per_sheet = CONTACT_SHEET_COLUMNS * CONTACT_SHEET_ROWS
+        for start in range(0, len(self._thumbnails), per_sheet):
+            sheet = contact_sheet(self._thumbnails[start:start + per_sheet], CONTACT_SHEET_COLUMNS, CONTACT_SHEET_CELL_SIZE)
+            sheet_name = CONTACT_SHEET_NAME.format(index=start // per_sheet + 1) + self.image_format
+            self._image_writer.write(os.path.join(self.labels_path, sheet_name), sheet, self.parameters)
+            sheet_names.append(sheet_name)
+        self._thumbnails = []
+
+        return sheet_names
+
+
+def thumbnail(image: np.ndarray,
+              cell_size: tuple) -> np.ndarray:
+    """
+    Resizes an image to fit in a cell of the contact sheet, keeping its aspect ratio.
+
+    Parameters:
+        - image (numpy.ndarray): The image to resize.
+        - cell_size (tuple): The (width, height) of the cell.
+
+    Returns:
+        - numpy.ndarray: The resized grayscale image.
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    height, width = image.shape
+    scale = min(cell_size[0] / width, cell_size[1] / height)
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def contact_sheet(thumbnails: list[tuple],
+                  columns: int,
+                  cell_size: tuple) -> np.ndarray:
+    """
+    Gathers thumbnails into a grid, each one being captioned with the index of its label.
+
+    Parameters:
+        - thumbnails (list): A list of tuples (label_index, thumbnail).
+        - columns (int): The number of columns of the grid.
+        - cell_size (tuple): The (width, height) of each cell.
+
+    Returns:
+        - numpy.ndarray: The grayscale contact sheet.
+    """
+    cell_width, cell_height = cell_size
+    caption_height = 24
+    rows = -(-len(thumbnails) // columns)
+    sheet = np.full((rows * (cell_height + caption_height), columns * cell_width), 255, dtype=np.uint8)
+
+    for k, (label_index, image) in enumerate(thumbnails):
+        top = (k // columns) * (cell_height + caption_height)
+        left = (k % columns) * cell_width
+        cv2.putText(sheet, str(label_index), (left + 4, top + caption_height - 6),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, 0, 1, cv2.LINE_AA)
+        height, width = image.shape
+        sheet[top + caption_height:top + caption_height + height, left:left + width] = image
+
+    return sheet
\ No newline at end of file
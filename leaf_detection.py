@@ -12,6 +12,7 @@ Date: 04/06/2024
 
 # Import libraries
 import os
+import struct
 import time
 
 import numpy as np
@@ -37,10 +38,26 @@ BINARY_INV_THRESHOLD = 245
 MIN_WIDTH = 400
 MIN_HEIGHT = 5_000
 
+# the height of the top of the bounding box removed to cut the stipule part of the leaf
+STIPULE_HEIGHT = 200
+
 # the minimum and maximum height of the input image
 MIN_HEIGHT_FILE = 11_000
 MAX_HEIGHT_FILE = 22_500
 
+# reduced-resolution decoding used for the pre-screening, the leaf detection and the text localisation
+# (the JPEG files are decoded with the DCT scaling of libjpeg, which is much faster than a full decoding)
+REDUCED_READ_MODE = cv2.IMREAD_REDUCED_COLOR_4
+DECODING_REDUCTION = 4
+
+# parameters of the pre-screening of the input images
+BLANK_STD_THRESHOLD = 4.0       # below this standard deviation of the intensity, the scan is considered blank
+BLUR_VARIANCE_THRESHOLD = 2.0   # below this variance of the laplacian, the scan is considered blurred
+
+# markers of the JPEG frames giving the dimensions of the image (SOF0 to SOF15, except DHT, JPG and DAC)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
 ########################################################################################################
 ############################                 Main Functions                 #############################
 ########################################################################################################
@@ -52,10 +69,14 @@ def leaf_detection(input_image: np.ndarray,
                    inv_threshold: int = BINARY_INV_THRESHOLD,
                    threshold_area: int = THRESHOLD_AREA,
                    min_width: int = MIN_WIDTH,
-                   min_height: int = MIN_HEIGHT) -> np.ndarray :
+                   min_height: int = MIN_HEIGHT,
+                   reduction: int = 1) -> np.ndarray :
     """
     Function to detect leaves in an image.
 
+    The image can be a reduced-resolution version of the scan (e.g. decoded with REDUCED_READ_MODE), in which case
+    the parameters are scaled by `reduction` and the bounding boxes are returned in full-resolution coordinates.
+
     Parameters:
         - input_image (numpy.ndarray): The input image where leaves are to be detected.
         - kernel_size (tuple): The size of the kernel used for blurring the image.
@@ -65,11 +86,18 @@ def leaf_detection(input_image: np.ndarray,
         - threshold_area (int): Minimum area of a contour to be considered a leaf.
         - min_width (int): Minimum width of a bounding box to be considered a leaf.
         - min_height (int): Minimum height of a bounding box to be considered a leaf.
+        - reduction (int): The reduction factor of the input image with respect to the full-resolution scan.
 
     Returns:
         - numpy.ndarray: An array of bounding boxes for the detected leaves.
     """
 
+    # Scale the parameters to the resolution of the input image
+    kernel_size = tuple(max(1, round(k / reduction)) for k in kernel_size)
+    threshold_area = threshold_area / reduction**2
+    min_width, min_height = min_width / reduction, min_height / reduction
+    stipule_height = round(STIPULE_HEIGHT / reduction)
+
     # Blur the image to reduce noise
     blurred_image = cv2.blur(input_image, kernel_size)
 
@@ -91,27 +119,122 @@ def leaf_detection(input_image: np.ndarray,
         if area > threshold_area:
             x, y, w, h = cv2.boundingRect(c)
             if w > min_width and h > min_height:
-                bounding_boxes.append([x, y+200, x+w, y+h]) # y+200 to cut the stipule part of the leaf
+                bounding_boxes.append([x, y+stipule_height, x+w, y+h]) # to cut the stipule part of the leaf
     
     # Sort the bounding boxes from left to right
     bounding_boxes = sorted(bounding_boxes, key=lambda b: b[0])
     
-    return np.array(bounding_boxes)
+    return np.array(bounding_boxes, dtype=int).reshape(-1, 4) * reduction
 
 
-def is_image_usable(image: np.ndarray) -> bool:
+def screen_image(path: str,
+                 reduced_decode: bool = True) -> tuple:
     """
-    Checks if the image is usable based on its dimensions.
-    
-    Args:
-    image (numpy.ndarray): Input image to check for usability.
-    
+    Checks if an image file is usable without decoding it at full resolution.
+
+    The dimensions are first read from the JPEG or PNG header. Then, if `reduced_decode` is True, the image is
+    decoded at a reduced resolution (1/DECODING_REDUCTION, using the DCT scaling of libjpeg for the JPEG files)
+    to reject the blank, blurred and leafless scans with cheap statistics.
+
+    Parameters:
+        - path (str): The path to the image file.
+        - reduced_decode (bool, optional): Whether to check the content of the image on a reduced-resolution
+                                           decoding. Defaults to True.
+
     Returns:
-    bool: True if the image is usable, False otherwise.
+        - tuple: A boolean, True if the image is usable, the reason of the rejection (None if usable) and the
+                 reduced-resolution image (None if not decoded), which can be reused for the leaf detection.
     """
+    # Check the dimensions read from the header
+    size = read_image_size(path)
+    if size is None:
+        return False, "unreadable image header", None
 
-    # Get the height of the image
-    height = image.shape[0]
-    
-    # Check if the height is within the acceptable range
-    return MIN_HEIGHT_FILE <= height <= MAX_HEIGHT_FILE
\ No newline at end of file
+    height = size[1]
+    if not MIN_HEIGHT_FILE <= height <= MAX_HEIGHT_FILE:
+        return False, f"height of {height} px outside [{MIN_HEIGHT_FILE}, {MAX_HEIGHT_FILE}]", None
+
+    if not reduced_decode:
+        return True, None, None
+
+    # Check the content of the image on a reduced-resolution decoding
+    reduced_image = cv2.imread(path, REDUCED_READ_MODE)
+    if reduced_image is None:
+        return False, "image cannot be decoded", None
+
+    grayscale_image = cv2.cvtColor(reduced_image, cv2.COLOR_BGR2GRAY)
+    if grayscale_image.std() < BLANK_STD_THRESHOLD:
+        return False, "blank image", reduced_image
+
+    if cv2.Laplacian(grayscale_image, cv2.CV_64F).var() < BLUR_VARIANCE_THRESHOLD:
+        return False, "blurred image", reduced_image
+
+    # Same criterion as the binarization of `leaf_detection`: a pixel belongs to a leaf if one of its channels is dark
+    leaf_area = np.count_nonzero(reduced_image.min(axis=2) <= BINARY_THRESHOLD) * DECODING_REDUCTION**2
+    if leaf_area < THRESHOLD_AREA:
+        return False, "no leaf", reduced_image
+
+    return True, None, reduced_image
+
+
+def read_image_size(path: str) -> tuple:
+    """
+    Reads the dimensions of a JPEG or PNG image from its header, without decoding it.
+
+    Parameters:
+        - path (str): The path to the image file.
+
+    Returns:
+        - tuple: The (width, height) of the image, or None if the header cannot be read.
+    """
+    try:
+        with open(path, 'rb') as file:
+            signature = file.read(8)
+            file.seek(0)
+            if signature.startswith(b'\xff\xd8'):
+                return _jpeg_size(file)
+            if signature == PNG_SIGNATURE:
+                return _png_size(file)
+    except (OSError, struct.error):
+        pass
+
+    return None
+
+########################################################################################################
+############################           Helper Functions                    #############################
+########################################################################################################
+
+def _jpeg_size(file) -> tuple:
+    """Read the (width, height) of a JPEG image from its start of frame segment."""
+    file.read(2) # start of image marker
+
+    while True:
+        # Find the next marker, skipping the fill bytes
+        byte = file.read(1)
+        while byte and byte != b'\xff':
+            byte = file.read(1)
+        while byte == b'\xff':
+            byte = file.read(1)
+        if not byte:
+            return None
+
+        marker = byte[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8: # markers without segment
+            continue
+        if marker in (0xD9, 0xDA): # end of image or start of scan before any frame
+            return None
+
+        length, = struct.unpack('>H', file.read(2))
+        if marker in JPEG_SOF_MARKERS:
+            _, height, width = struct.unpack('>BHH', file.read(5))
+            return width, height
+        file.seek(length - 2, os.SEEK_CUR)
+
+
+def _png_size(file) -> tuple:
+    """Read the (width, height) of a PNG image from its IHDR chunk."""
+    file.read(8) # signature
+    _, chunk_type, width, height = struct.unpack('>I4sII', file.read(16))
+    if chunk_type != b'IHDR':
+        return None
+    return width, height
\ No newline at end of file
@@ -18,7 +18,16 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import pandas as pd
 
+from fault_isolation import MAX_RETRIES
+from fault_isolation import SCAN_TIMEOUT
+from label_snapshots import LABEL_FORMAT
+from label_snapshots import LABEL_FORMATS
+from label_snapshots import LABEL_QUALITY
 from main import main
+from segmentation import BACKENDS
+from segmentation import SEGMENTATION_BACKEND
+from utils import merge_shards
+from utils import parse_shard
 
 def browse_directory(directory_var: str, button: tk.Button) -> None:
     """Open a file dialog and set the directory_var to the selected directory."""
@@ -53,14 +62,57 @@ def parse_args():
     parser.add_argument('-i', '--input', help='Input directory')
     parser.add_argument('-o', '--output', help='Output directory')
     parser.add_argument('-p', '--model', help='model path')
+    parser.add_argument('-b', '--backend', default=SEGMENTATION_BACKEND, choices=list(BACKENDS), help='segmentation backend')
+    parser.add_argument('-t', '--tile-height', type=positive_int_type, help='segment the leaves in overlapping tiles of this height')
+    parser.add_argument('--scan-timeout', type=float, default=SCAN_TIMEOUT, help='kill the worker process of a scan after this time in seconds')
+    parser.add_argument('--in-process', action='store_true', help='process the scans in the main process, without timeout')
+    parser.add_argument('--retries', type=int, default=MAX_RETRIES, help='number of retries of a failed scan')
+    parser.add_argument('-e', '--extended', action='store_true', help='compute the lesion statistics')
+    parser.add_argument('-s', '--shard', type=shard_type, help='process only the shard i/N of the input images')
+    parser.add_argument('--label-format', default=LABEL_FORMAT, choices=LABEL_FORMATS, help='extension of the label snapshots')
+    parser.add_argument('--label-quality', type=quality_type, default=LABEL_QUALITY, help='quality of the label snapshots, from 0 to 100')
+    parser.add_argument('--contact-sheet', action='store_true', help='also gather the label snapshots into contact sheets')
+    parser.add_argument('-m', '--merge', action='store_true', help='merge the results of the shards of the output directory')
     return parser.parse_args()
 
+def shard_type(value: str) -> tuple:
+    """Convert a shard given as 'i/N' on the command line to the tuple (i, N)."""
+    try:
+        return parse_shard(value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+def positive_int_type(value: str) -> int:
+    """Convert a positive integer given on the command line."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid integer: '{value}'")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {number}")
+    return number
+
+def quality_type(value: str) -> int:
+    """Convert a quality from 0 to 100 given on the command line."""
+    try:
+        quality = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid integer: '{value}'")
+    if not 0 <= quality <= 100:
+        raise argparse.ArgumentTypeError(f"must be from 0 to 100, got {quality}")
+    return quality
+
 def main_cli() -> None:
     """Run the main function with command line arguments."""
     args = parse_args()
-    if args.input and args.output and args.model:
+    if args.merge and args.output:
+        merge_shards(args.output)
+    elif args.input and args.output and args.model:
         #main(args.input, args.output, args.model)
-        main(input_directory = args.input, output_directory = args.output, model_path = args.model)
+        main(input_directory = args.input, output_directory = args.output, model_path = args.model, extended_analysis = args.extended, shard = args.shard,
+             label_format = args.label_format, label_quality = args.label_quality, contact_sheet = args.contact_sheet,
+             segmentation_backend = args.backend, tile_height = args.tile_height,
+             scan_timeout = None if args.in_process else args.scan_timeout, max_retries = args.retries)
     else:
         print("Input, output directories and model path must be provided.")
         sys.exit(1)
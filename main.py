@@ -9,22 +9,57 @@ Authors: LE GOURRIEREC Titouan, CONNESSON Léna, PROUVOST Axel
 Date: 04/06/2024
 """
 
+import contextlib
+import glob
 import os
 import shutil
 import time
 
 import cv2
 import pandas
-from EasIlastik.run_ilastik import run_ilastik
+
+from fault_isolation import dead_letter
+from fault_isolation import log_error
+from fault_isolation import run_with_retries
+from fault_isolation import IsolatedRunner
+from fault_isolation import DEAD_LETTER_DIR
+from fault_isolation import ERRORS_FILE
+from fault_isolation import MAX_RETRIES
+from fault_isolation import RETRY_DELAY
+from fault_isolation import SCAN_TIMEOUT
 
 from leaf_detection import leaf_detection
-from leaf_detection import is_image_usable
+from leaf_detection import screen_image
+from leaf_detection import DECODING_REDUCTION
 
 from text_detection import text_detection
+from text_detection import locate_text
+
+from image_writer import ImageWriter
+
+from shared_images import CropExecutor
+
+from segmentation import get_backend
+from segmentation import SEGMENTATION_BACKEND
+
+from label_snapshots import encoding_parameters
+from label_snapshots import LabelSnapshotWriter
+from label_snapshots import LABEL_FORMAT
+from label_snapshots import LABEL_QUALITY
 
 from utils import setup_workspace
-from utils import convert_color_space
+from utils import convert_crop_color_space
 from utils import leaves_analysis
+from utils import lesions_analysis
+from utils import list_images
+from utils import COLOR_SPACE_CONVERSIONS
+from utils import COLOR_SPACE_DIR
+from utils import LESIONS_FILE
+from utils import NEW_RESULTS_DIR
+from utils import RESULTS_FILE
+from utils import SEGMENTED_LEAVES_DIR
+from utils import SHARD_RESULTS_DIR
+from utils import UNUSABLE_FILES_FILE
 from utils import status_update
 
 ########################################################################################################
@@ -36,6 +71,7 @@ COLOR_SPACE = 'LAB'
 MODEL_PATH = ''
 LABELS_WIDTH_PIXELS = 700
 LABELS_WIDTH_MM = 12.7
+EXTENDED_ANALYSIS = False
 
 # Constants
 COLOR_SPACES = ['YUV', 'HSV', 'LAB', 'HLS']
@@ -50,7 +86,16 @@ def main(input_directory: str,
          output_directory: str,
          update_status = None, 
          model_path: str = MODEL_PATH,
-         color_space: str = COLOR_SPACE) -> None:
+         color_space: str = COLOR_SPACE,
+         extended_analysis: bool = EXTENDED_ANALYSIS,
+         shard: tuple = None,
+         label_format: str = LABEL_FORMAT,
+         label_quality: int = LABEL_QUALITY,
+         contact_sheet: bool = False,
+         segmentation_backend: str = SEGMENTATION_BACKEND,
+         tile_height: int = None,
+         scan_timeout: float = SCAN_TIMEOUT,
+         max_retries: int = MAX_RETRIES) -> None:
     """
     Main function to process the images of leaves and extract the required information.
 
@@ -60,26 +105,59 @@ def main(input_directory: str,
         - update_status (function, optional): A function to update the status of the process. Defaults to None.
         - model_path (str, optional): The path to the model. Defaults to MODEL_PATH.
         - color_space (str, optional): The color space to be used for image processing. Defaults to COLOR_SPACE.
+        - extended_analysis (bool, optional): Whether to compute the lesion statistics (counts, sizes and positions)
+                                              and save them in results.csv and lesions.csv. Defaults to EXTENDED_ANALYSIS.
+        - shard (tuple, optional): The index and the number of shards (i, N). When given, only the images assigned
+                                   to the shard i are processed, into the directory Results_shard_i_of_N. The shards
+                                   are then combined with `utils.merge_shards`. Defaults to None.
+        - label_format (str, optional): The extension of the label snapshots. Defaults to LABEL_FORMAT.
+        - label_quality (int, optional): The quality of the label snapshots, from 0 to 100. Defaults to LABEL_QUALITY.
+        - contact_sheet (bool, optional): Whether to also gather the label snapshots into contact sheets. Defaults to False.
+        - segmentation_backend (str, optional): The segmentation backend, 'ilastik' (model_path is an Ilastik project)
+                                                or 'pixel' (model_path is a model trained with
+                                                `segmentation.train_pixel_classifier`). Defaults to SEGMENTATION_BACKEND.
+        - tile_height (int, optional): If given, the leaves are segmented in overlapping tiles of this height, which
+                                       bounds the memory used by the segmentation. Defaults to None (whole leaves).
+        - scan_timeout (float, optional): Each scan is processed in a worker process, killed if the scan takes more
+                                          than this time in seconds, or in the current process without timeout if
+                                          None. Defaults to SCAN_TIMEOUT.
+        - max_retries (int, optional): The number of retries of a failed scan before it is copied to the Dead_Letter
+                                       directory and logged in errors.csv. Defaults to MAX_RETRIES.
     """
     # Start of process
     start_process = status_update(update_status, "Start of process.\n")
+
+    # Only convert the leaves to the color space if the segmentation backend expects it
+    backend = get_backend(segmentation_backend, model_path, tile_height)
+    if not backend.uses_color_space:
+        color_space = None
     
     # Extraction of leaves and labels
     start = status_update(update_status, "Start of extraction of leaves and labels.")
-    results_path, file_path, _, _, results_dataframe, _, _ = save_leaves(input_directory, output_directory)
+    image_writer = ImageWriter()
+    results_path, file_path, _, _, results_dataframe, _, _ = save_leaves(input_directory, output_directory, shard,
+                                                                               label_format, label_quality, contact_sheet,
+                                                                               image_writer, color_space,
+                                                                               scan_timeout, max_retries, update_status)
+
+    # Wait for all the images to be written before the segmentation
+    image_writer.close()
+    metrics = image_writer.metrics()
+    status_update(update_status, f"Images written: {metrics['images']} ({round(metrics['bytes'] / 1e6)} MB) in "
+                                 f"{metrics['encode_time']}s of encoding, {metrics['images_per_second']} images/s and "
+                                 f"{metrics['megabytes_per_second']} MB/s per encoding thread, "
+                                 f"maximum queue depth {metrics['max_queue_depth']}.")
     status_update(update_status, f"End of extraction of leaves and labels. ({round(time.time() - start)}s)\n")
     
-    # Color space conversion
-    start = status_update(update_status, "Start of color space conversion.")
+    # The color space conversion is done on the leaves during the extraction
     if color_space in COLOR_SPACES:
-        color_space_subdir = convert_color_space(file_path, results_path, color_space)
+        color_space_subdir = os.path.join(results_path, COLOR_SPACE_DIR)
     else:
         color_space_subdir = file_path
-    status_update(update_status, f"End of color space conversion. ({round(time.time() - start)}s)\n")
 
     # Leaves segmentation
     start = status_update(update_status, "Start of leaves segmentation.")
-    segmented_leaves_path = os.path.join(results_path, 'segmented_leaves') + '/'
+    segmented_leaves_path = os.path.join(results_path, SEGMENTED_LEAVES_DIR) + '/'
     os.makedirs(segmented_leaves_path, exist_ok=True)
 
     if color_space in COLOR_SPACES:
@@ -87,9 +165,7 @@ def main(input_directory: str,
     else:
         input_path = file_path
 
-    run_ilastik(input_path = input_path,
-                model_path = model_path,
-                result_base_path = segmented_leaves_path)
+    backend.segment_directory(input_path, segmented_leaves_path)
     
     if color_space in COLOR_SPACES:
         shutil.rmtree(color_space_subdir)
@@ -116,8 +192,14 @@ def main(input_directory: str,
     results_dataframe['oidium_area'] = oidium_area
     results_dataframe['rust_area'] = rust_area
 
+    # Add the lesion statistics and save the per-lesion table
+    if extended_analysis:
+        lesions_summary, lesions_dataframe = lesions_analysis(results_dataframe, segmented_leaves_path, PIXEL_AREA)
+        results_dataframe = pandas.concat([results_dataframe, lesions_summary], axis=1)
+        lesions_dataframe.to_csv(os.path.join(results_path, LESIONS_FILE), index=False)
+
     # Save the results to a CSV file
-    results_dataframe.to_csv(os.path.join(results_path, 'results.csv'), index=False)
+    results_dataframe.to_csv(os.path.join(results_path, RESULTS_FILE), index=False)
     status_update(update_status, f"End of results analysis. ({round(time.time() - start)}s)\n")
     
     # End of process
@@ -128,81 +210,240 @@ def main(input_directory: str,
 ########################################################################################################
 
 def save_leaves(input_directory: str,
-                output_directory: str) -> tuple:
+                output_directory: str,
+                shard: tuple = None,
+                label_format: str = LABEL_FORMAT,
+                label_quality: int = LABEL_QUALITY,
+                contact_sheet: bool = False,
+                image_writer: ImageWriter = None,
+                color_space: str = None,
+                scan_timeout: float = SCAN_TIMEOUT,
+                max_retries: int = MAX_RETRIES,
+                update_status = None) -> tuple:
     """
     This function extracts leaves and labels from images and saves them to files.
+
+    Each scan is processed independently: a scan which fails (or exceeds `scan_timeout`) is retried `max_retries`
+    times, then copied to the Dead_Letter directory and skipped, the errors being logged in errors.csv.
     
     Parameters:
     input_directory (str): The directory where the input images are stored.
     output_directory (str): The directory where the output files should be saved.
+    shard (tuple, optional): The index and the number of shards (i, N) to process. Defaults to None (all the images).
+    label_format (str, optional): The extension of the label snapshots. Defaults to LABEL_FORMAT.
+    label_quality (int, optional): The quality of the label snapshots, from 0 to 100. Defaults to LABEL_QUALITY.
+    contact_sheet (bool, optional): Whether to also gather the label snapshots into contact sheets. Defaults to False.
+    image_writer (ImageWriter, optional): The writer of the images, flushed after each scan so that a failed write
+                                          fails the scan which produced it. If given, the caller has to close the
+                                          writer. Defaults to None (a writer is created and closed by the function).
+    color_space (str, optional): If one of COLOR_SPACES, the leaves are also converted to this color space by worker
+                                 processes, reading them from the shared memory, and saved in the color_space
+                                 directory. Defaults to None.
+    scan_timeout (float, optional): Each scan is processed in a worker process, killed if the scan takes more than
+                                    this time in seconds, or in the current process without timeout if None.
+                                    Defaults to SCAN_TIMEOUT.
+    max_retries (int, optional): The number of retries of a failed scan. Defaults to MAX_RETRIES.
+    update_status (function, optional): A function to report the failed scans. Defaults to None.
 
     Returns:
     tuple: A tuple containing the paths to the results, file, unusable file, and labels directories, 
            and a DataFrame containing the results.
     """
     
+    # Check the format of the label snapshots before setting up the workspace
+    encoding_parameters(label_format, label_quality)
+
     # Set up the workspace
-    results_path, file_path, unusable_file_path, labels_path = setup_workspace(output_directory)
+    if shard is None:
+        results_dir = NEW_RESULTS_DIR
+    else:
+        results_dir = SHARD_RESULTS_DIR.format(index=shard[0], count=shard[1])
+    results_path, file_path, unusable_file_path, labels_path = setup_workspace(output_directory, results_dir)
+    own_image_writer = image_writer is None
+    if own_image_writer:
+        image_writer = ImageWriter()
+    label_writer = LabelSnapshotWriter(image_writer, labels_path, label_format, label_quality, contact_sheet)
+
+    # Set up the conversion of the leaves to the color space, in worker processes reading the leaves from the shared
+    # memory, or directly by the isolated worker processing the scan
+    color_space_path = None
+    converter = None
+    if color_space in COLOR_SPACES:
+        color_space_path = os.path.join(results_path, COLOR_SPACE_DIR)
+        os.makedirs(color_space_path, exist_ok=True)
+        if scan_timeout is None:
+            converter = CropExecutor(convert_crop_color_space)
+
+    # Set up the isolation of the scans
+    runner = None if scan_timeout is None else IsolatedRunner()
+    dead_letter_path = os.path.join(results_path, DEAD_LETTER_DIR)
+    errors_path = os.path.join(results_path, ERRORS_FILE)
 
     # Initialize lists to store the results
     R_list, P_list, code_champ_list, M_list, EPO_list = [], [], [], [], []
     labels_index = []
+    label_snapshots = []
     original_file_names = []
     new_file_names = []
+    unusable_file_names = []
+    unusable_reasons = []
     
     count_usable_files = 1
     count_unusable_files = 0
 
-    for filename in os.listdir(input_directory):
-        # Check if the file is an image file
-        if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
-
-            # Create the full path to the image file
-            full_path = os.path.join(input_directory, filename)
-
-            # Read the image file
-            img = cv2.imread(full_path)
-
-            # Check if the image is usable
-            if not is_image_usable(img):
-                # Save the unusable file to the unusable_file_path directory
-                cv2.imwrite(os.path.join(unusable_file_path, f"Unusable_File_{filename}"), img)
-                count_unusable_files += 1
-
+    def on_failure(filename: str, label_index: int, attempt: int, error: Exception) -> None:
+        """Log the error and remove the partial outputs of the scan."""
+        status_update(update_status, f"Failed to process {filename} (attempt {attempt}): {type(error).__name__}: {error}")
+        log_error(errors_path, filename, attempt, error)
+        _remove_scan_outputs(label_index, file_path, labels_path, color_space_path, label_writer)
+
+    def process_scan(filename: str, label_index: int, first_attempt: int = 1, settle: bool = False) -> dict:
+        """
+        Process a scan with retries, in the current process or in the isolated worker. Unless `settle` is True,
+        its outputs may still be being written when it returns. Returns None if the scan is put in the dead-letter
+        directory.
+        """
+        full_path = os.path.join(input_directory, filename)
+        failures = []
+
+        def on_attempt_failure(attempt: int, error: Exception) -> None:
+            failures.append(error)
+            on_failure(filename, label_index, first_attempt + attempt - 1, error)
+
+        if runner is None:
+            scan, errors = run_with_retries(_extract_scan_in_process,
+                                            (full_path, label_index, file_path, image_writer, label_writer,
+                                             color_space_path, color_space, converter, settle),
+                                            max_retries + 1 - first_attempt, on_failure=on_attempt_failure)
+        else:
+            scan, errors = run_with_retries(_extract_scan_isolated,
+                                            (full_path, label_index, file_path, labels_path, label_format,
+                                             label_quality, color_space_path, color_space, settle),
+                                            max_retries + 1 - first_attempt, runner, scan_timeout, on_attempt_failure)
+
+        if errors:
+            # Put the scan aside to process it again later
+            dead_letter(full_path, dead_letter_path)
+            return None
+
+        scan.update(filename=filename, label_index=label_index, attempt=first_attempt + len(failures))
+        if runner is not None:
+            if settle:
+                image_writer.add_metrics(scan.pop('metrics'))
+            if scan.get('snapshot') is not None:
+                label_writer.add_to_contact_sheet(label_index, scan['snapshot'])
+        return scan
+
+    def settle_scan(scan: dict) -> dict:
+        """
+        Wait for the outputs of a scan, processing it again if they could not be written. Returns the scan, or None
+        if it is put in the dead-letter directory.
+        """
+        try:
+            if runner is None:
+                _settle_scan_outputs(scan['label_index'], image_writer, converter)
             else:
-                R, P, code_champ, M, EPO, text_box_result = text_detection(img)
-
-                # Save the labels to the labels_path directory
-                cv2.imwrite(os.path.join(labels_path, f"Labels_{count_usable_files}.jpg"), text_box_result)
-
-                # Detect leaves in the image
-                bounding_boxes = leaf_detection(img)
-                #original_file_name, extension = os.path.splitext(os.path.basename(full_path))
-                
-                # Save the processed image to the file_path directory
-                for j, box in enumerate(bounding_boxes):
-                    x1, y1, x2, y2 = box
-                    part = img[y1:y2, x1:x2]
-                    #new_file_name = f"{count_usable_files}_leaf{j + 1}{extension}"
-                    new_file_name = f"{count_usable_files}_leaf{j + 1}.png"
-                    cv2.imwrite(os.path.join(file_path, new_file_name), part)
-
-                    R_list.append(R)
-                    P_list.append(P)
-                    code_champ_list.append(code_champ)
-                    M_list.append(M)
-                    EPO_list.append(EPO)
-                    labels_index.append(count_usable_files)
-                    original_file_names.append(filename)
-                    new_file_names.append(new_file_name)
-
-                count_usable_files += 1
+                image_writer.add_metrics(runner.run(_settle_scan_isolated, (scan['label_index'],), scan_timeout))
+            return scan
+        except Exception as error:
+            on_failure(scan['filename'], scan['label_index'], scan['attempt'], error)
+
+        if scan['attempt'] > max_retries:
+            dead_letter(os.path.join(input_directory, scan['filename']), dead_letter_path)
+            return None
+        time.sleep(RETRY_DELAY)
+        return process_scan(scan['filename'], scan['label_index'], scan['attempt'] + 1, settle=True)
+
+    def record_scan(scan: dict) -> None:
+        """Add the leaves of a scan to the results, or the scan to the unusable files."""
+        nonlocal count_unusable_files
+
+        if scan is None:
+            return
+
+        if not scan['usable']:
+            # Copy the unusable file to the unusable_file_path directory and log the reason
+            shutil.copy2(os.path.join(input_directory, scan['filename']),
+                         os.path.join(unusable_file_path, f"Unusable_File_{scan['filename']}"))
+            unusable_file_names.append(scan['filename'])
+            unusable_reasons.append(scan['reason'])
+            count_unusable_files += 1
+            return
+
+        R, P, code_champ, M, EPO = scan['text']
+        for new_file_name in scan['leaves']:
+            R_list.append(R)
+            P_list.append(P)
+            code_champ_list.append(code_champ)
+            M_list.append(M)
+            EPO_list.append(EPO)
+            labels_index.append(scan['label_index'])
+            label_snapshots.append(scan['label_snapshot'])
+            original_file_names.append(scan['filename'])
+            new_file_names.append(new_file_name)
+
+    # The outputs of each scan are written while the next scan is processed, then settled: a scan whose outputs
+    # could not be written is processed again or put in the dead-letter directory
+    pending_scan = None
+
+    for filename in list_images(input_directory, shard):
+
+        scan = process_scan(filename, count_usable_files)
+
+        if pending_scan is not None:
+            record_scan(settle_scan(pending_scan))
+            pending_scan = None
+
+        # A scan without leaves does not use its label, so that the labels are numbered as by `merge_shards`
+        if scan is not None and scan['usable'] and scan['leaves']:
+            pending_scan = scan
+            count_usable_files += 1
+        else:
+            record_scan(scan)
+
+    if pending_scan is not None:
+        record_scan(settle_scan(pending_scan))
+
+    if runner is not None:
+        runner.close()
+
+    # Renumber the labels if a scan failed after the next scan was given the next label
+    new_labels = {label: k + 1 for k, label in enumerate(dict.fromkeys(labels_index))}
+    if any(label != new_label for label, new_label in new_labels.items()):
+        _renumber_labels(new_labels, file_path, labels_path, color_space_path)
+        label_writer.relabel(new_labels)
+        new_file_names = [f"{new_labels[label]}_{name.split('_', 1)[1]}" for label, name in zip(labels_index, new_file_names)]
+        label_snapshots = [f"Labels_{new_labels[label]}{os.path.splitext(name)[1]}" if name else ''
+                           for label, name in zip(labels_index, label_snapshots)]
+        labels_index = [new_labels[label] for label in labels_index]
+    count_usable_files = len(new_labels) + 1
+
+    # Queue the contact sheets and wait for them to be written, a failed contact sheet does not fail the scans
+    sheet_names = label_writer.close()
+    try:
+        image_writer.flush()
+    except Exception as error:
+        status_update(update_status, f"Failed to write the contact sheets: {type(error).__name__}: {error}")
+        log_error(errors_path, ', '.join(sheet_names), 1, error)
+    if own_image_writer:
+        image_writer.close()
+
+    # Stop the workers converting the color space and free the shared memory
+    if converter is not None:
+        converter.close()
     
+    # Save the reasons of the rejection of the unusable files
+    pandas.DataFrame({
+        'Original_File_Name': unusable_file_names,
+        'Reason': unusable_reasons
+    }).to_csv(os.path.join(results_path, UNUSABLE_FILES_FILE), index=False)
+
     # Create a DataFrame to store the results
     results = pandas.DataFrame({
         'Original_File_Name': original_file_names,
         'New_File_Name': new_file_names,
         'Label': labels_index,
+        'Label_Snapshot': label_snapshots,
         'R': R_list,
         'P': P_list,
         'Code_Champ': code_champ_list,
@@ -210,4 +451,213 @@ def save_leaves(input_directory: str,
         'EPO': EPO_list
     })
 
-    return results_path, file_path, unusable_file_path, labels_path, results, count_usable_files, count_unusable_files
\ No newline at end of file
+    return results_path, file_path, unusable_file_path, labels_path, results, count_usable_files, count_unusable_files
+
+
+def extract_scan(full_path: str,
+                 label_index: int,
+                 file_path: str,
+                 image_writer: ImageWriter,
+                 label_writer: LabelSnapshotWriter) -> dict:
+    """
+    Extracts the leaves and the label of one scan and queues them for writing, tagged with the index of the label.
+
+    Parameters:
+        - full_path (str): The path to the scan.
+        - label_index (int): The index of the label of the scan, used in the names of the output files.
+        - file_path (str): The directory where the leaves should be saved.
+        - image_writer (ImageWriter): The writer of the leaves.
+        - label_writer (LabelSnapshotWriter): The writer of the label snapshot.
+
+    Returns:
+        - dict: For an unusable scan, {'usable': False, 'reason': ...}. Otherwise, 'usable' is True and 'leaves'
+                gives the names of the leaves, 'bounding_boxes' their bounding boxes, 'text' the values of
+                R, P, code_champ, M and EPO, 'label_snapshot' the name of the label snapshot ('' if no text is
+                detected), 'snapshot' the label snapshot and 'image' the full-resolution scan.
+    """
+    # Check if the image is usable from its header and a reduced-resolution decoding
+    usable, reason, reduced_img = screen_image(full_path)
+    if not usable:
+        return {'usable': False, 'reason': reason}
+
+    # Detect leaves and localise the text on the reduced-resolution image
+    bounding_boxes = leaf_detection(reduced_img, reduction=DECODING_REDUCTION)
+
+    # Decode the image at full resolution only if it contains leaves
+    scan = {'usable': True, 'leaves': [], 'bounding_boxes': bounding_boxes, 'text': (None,) * 5,
+            'label_snapshot': '', 'snapshot': None, 'image': None}
+    if len(bounding_boxes) == 0:
+        return scan
+
+    text_region = locate_text(reduced_img, DECODING_REDUCTION)
+    img = cv2.imread(full_path)
+    if img is None:
+        raise ValueError(f"The image {os.path.basename(full_path)} cannot be decoded at full resolution.")
+
+    # Read the text on the full-resolution crop of the region containing it
+    if text_region is None:
+        R, P, code_champ, M, EPO, text_box_result = text_detection(img)
+    else:
+        x1, y1, x2, y2 = text_region
+        R, P, code_champ, M, EPO, text_box_result = text_detection(img[y1:y2, x1:x2])
+
+    # Save the labels to the labels_path directory, an empty name marks the scans without any text detected
+    if text_box_result is not None:
+        scan['label_snapshot'] = label_writer.write(label_index, text_box_result)
+
+    # Save the processed image to the file_path directory
+    for j, box in enumerate(bounding_boxes):
+        x1, y1, x2, y2 = box
+        part = img[y1:y2, x1:x2]
+        new_file_name = f"{label_index}_leaf{j + 1}.png"
+        image_writer.write(os.path.join(file_path, new_file_name), part, tag=label_index)
+        scan['leaves'].append(new_file_name)
+
+    scan.update(text=(R, P, code_champ, M, EPO), snapshot=text_box_result, image=img)
+
+    return scan
+
+
+def _extract_scan_in_process(full_path: str,
+                             label_index: int,
+                             file_path: str,
+                             image_writer: ImageWriter,
+                             label_writer: LabelSnapshotWriter,
+                             color_space_path: str = None,
+                             color_space: str = None,
+                             converter: CropExecutor = None,
+                             settle: bool = False) -> dict:
+    """
+    Extract one scan in the current process. Its outputs are written in the background, until they are settled with
+    `_settle_scan_outputs` (directly if `settle` is True). If a converter is given, the leaves are also converted to
+    the color space by its worker processes, which read them from the shared memory.
+    """
+    try:
+        scan = extract_scan(full_path, label_index, file_path, image_writer, label_writer)
+
+        if scan['usable'] and converter is not None:
+            converter.submit(label_index, scan['image'], scan['bounding_boxes'],
+                             [(os.path.join(color_space_path, new_file_name), color_space) for new_file_name in scan['leaves']])
+
+    except Exception:
+        # Wait for the outputs of the scan already queued before its partial outputs are removed, their errors
+        # being superseded by the error of the scan
+        with contextlib.suppress(Exception):
+            _settle_scan_outputs(label_index, image_writer, converter)
+        raise
+
+    if settle:
+        _settle_scan_outputs(label_index, image_writer, converter)
+
+    # Do not keep the full-resolution scan while its outputs are written
+    scan.pop('image', None)
+    return scan
+
+
+def _settle_scan_outputs(label_index: int,
+                         image_writer: ImageWriter,
+                         converter: CropExecutor = None) -> None:
+    """Wait for the outputs of a scan, raising the first error of its writes and color space conversions."""
+    try:
+        image_writer.settle(label_index)
+    finally:
+        if converter is not None:
+            converter.settle(label_index)
+
+
+# Image writer of the isolated worker process, kept between the scans, and the labels of the scans whose outputs
+# it is writing
+WORKER_IMAGE_WRITER = None
+WORKER_LABELS = set()
+
+
+def _extract_scan_isolated(full_path: str,
+                           label_index: int,
+                           file_path: str,
+                           labels_path: str,
+                           label_format: str,
+                           label_quality: int,
+                           color_space_path: str,
+                           color_space: str,
+                           settle: bool = False) -> dict:
+    """
+    Extract one scan in an isolated worker process. Its outputs are written in the background of the worker, until
+    they are settled with `_settle_scan_isolated` (directly if `settle` is True, the metrics of the writes being
+    then returned in 'metrics').
+    """
+    global WORKER_IMAGE_WRITER
+
+    if WORKER_IMAGE_WRITER is None:
+        WORKER_IMAGE_WRITER = ImageWriter()
+    image_writer = WORKER_IMAGE_WRITER
+    WORKER_LABELS.add(label_index)
+
+    try:
+        label_writer = LabelSnapshotWriter(image_writer, labels_path, label_format, label_quality)
+        scan = extract_scan(full_path, label_index, file_path, image_writer, label_writer)
+
+        # Convert the leaves to the color space directly, the scan being already in this process
+        if scan['usable'] and color_space in COLOR_SPACES:
+            for (x1, y1, x2, y2), new_file_name in zip(scan['bounding_boxes'], scan['leaves']):
+                converted_img = cv2.cvtColor(scan['image'][y1:y2, x1:x2], COLOR_SPACE_CONVERSIONS[color_space])
+                image_writer.write(os.path.join(color_space_path, new_file_name), converted_img, tag=label_index)
+
+    except Exception:
+        # Wait for the images of the scan already queued, their errors being superseded by the error of the scan
+        with contextlib.suppress(Exception):
+            _settle_scan_isolated(label_index)
+        raise
+
+    if settle:
+        scan['metrics'] = _settle_scan_isolated(label_index)
+
+    # Do not send the full-resolution scan back to the main process
+    scan.pop('image', None)
+    return scan
+
+
+def _settle_scan_isolated(label_index: int) -> dict:
+    """Wait for the outputs of a scan in the isolated worker process, returning the metrics of its writes."""
+    if label_index not in WORKER_LABELS:
+        raise RuntimeError("The worker process was stopped before the outputs of the scan were written.")
+    WORKER_LABELS.discard(label_index)
+
+    return WORKER_IMAGE_WRITER.settle(label_index)
+
+
+def _remove_scan_outputs(label_index: int,
+                         file_path: str,
+                         labels_path: str,
+                         color_space_path: str = None,
+                         label_writer: LabelSnapshotWriter = None) -> None:
+    """Remove the outputs already written for a scan which failed."""
+    if label_writer is not None:
+        label_writer.discard(label_index)
+
+    patterns = [os.path.join(file_path, f"{label_index}_leaf*.png"),
+                os.path.join(labels_path, f"Labels_{label_index}.*")]
+    if color_space_path is not None:
+        patterns.append(os.path.join(color_space_path, f"{label_index}_leaf*.png"))
+
+    for pattern in patterns:
+        for path in glob.glob(pattern):
+            os.remove(path)
+
+
+def _renumber_labels(new_labels: dict,
+                     file_path: str,
+                     labels_path: str,
+                     color_space_path: str = None) -> None:
+    """Rename the outputs of the scans after their labels are renumbered in the same order, without gaps."""
+    leaves_paths = [file_path] if color_space_path is None else [file_path, color_space_path]
+
+    # The new labels are not greater than the old ones, so renaming in increasing order never overwrites a file
+    for label, new_label in sorted(new_labels.items()):
+        if label == new_label:
+            continue
+        for path in leaves_paths:
+            for leaf_path in glob.glob(os.path.join(path, f"{label}_leaf*.png")):
+                leaf_name = os.path.basename(leaf_path).split('_', 1)[1]
+                os.rename(leaf_path, os.path.join(path, f"{new_label}_{leaf_name}"))
+        for snapshot_path in glob.glob(os.path.join(labels_path, f"Labels_{label}.*")):
+            os.rename(snapshot_path, os.path.join(labels_path, f"Labels_{new_label}{os.path.splitext(snapshot_path)[1]}"))
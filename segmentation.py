@@ -0,0 +1,417 @@
+"""
+Segmentation Module
+---------------------
+
+Description:
+This file contains the segmentation backends. A backend segments the leaves into the four classes expected by
+`utils.leaves_analysis` (background, healthy, oidium and rust) and saves the label maps as
+'<leaf>_Simple_Segmentation.png'. Two backends are available: Ilastik, run through EasIlastik, and a native
+pixel classifier over color-space features, running in-process with NumPy and OpenCV. The long leaves can
+be segmented in overlapping tiles, whose label maps are stitched after trimming their halo.
+
+Authors: LE GOURRIEREC Titouan, CONNESSON Léna, PROUVOST Axel
+Date: 04/06/2024
+"""
+
+import abc
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from leaf_detection import read_image_size
+from utils import BACKGROUND_VALUE
+from utils import HEALTHY_VALUE
+from utils import OIDIUM_VALUE
+from utils import RUST_VALUE
+from utils import COLOR_SPACE_CONVERSIONS
+from utils import IMAGE_EXTENSIONS
+
+########################################################################################################
+############################           Parameters & Constants              #############################
+########################################################################################################
+
+SEGMENTATION_BACKEND = 'ilastik'
+SEGMENTATION_SUFFIX = '_Simple_Segmentation.png'
+
+# Grey levels of the classes in the label maps, in the order of the labels of the Ilastik projects
+CLASS_VALUES = [BACKGROUND_VALUE, HEALTHY_VALUE, OIDIUM_VALUE, RUST_VALUE]
+
+# Color spaces whose channels are used as features by the pixel classifier (BGR being the input color space)
+FEATURE_COLOR_SPACES = ['LAB', 'HSV', 'YUV', 'HLS']
+
+# Regularization added to the diagonal of the covariance matrices of the pixel classifier
+COVARIANCE_REGULARIZATION = 1e-3
+
+# Number of pixels whose features are computed and classified at once (in whole rows), to bound the memory used
+# by the classification of a leaf (about 100 bytes per pixel)
+CLASSIFICATION_CHUNK_SIZE = 1_000_000
+
+# Maximum number of leaves, or tiles, segmented at once by the in-process backends
+SEGMENTATION_WORKERS = 4
+
+# Tiled segmentation: height of the tiles (without halo) and height of the halo added above and below each tile.
+# The result is identical to the whole-leaf segmentation as long as the halo is at least the context radius of
+# the backend, i.e. the distance up to which the neighbourhood of a pixel influences its label.
+TILE_HEIGHT = 2_048
+TILE_HALO = 64
+
+# Context radius of the Ilastik features (3.5 times the largest Gaussian scale, 10 px, of the default features)
+ILASTIK_CONTEXT_RADIUS = 35
+TILES_DIR = 'tiles'
+SEGMENTED_TILES_DIR = 'segmented_tiles'
+
+########################################################################################################
+############################                 Main Functions                 #############################
+########################################################################################################
+
+class SegmentationBackend(abc.ABC):
+    """
+    Base class of the segmentation backends.
+
+    A backend implements `segment_directory`, or `segment_image` if it derives from `InProcessBackend`. The
+    attribute `uses_color_space` tells if the backend expects the leaves converted to the color space of the model
+    (True) or the original BGR leaves (False), and `context_radius` is the distance in pixels up to which the
+    neighbourhood of a pixel influences its label.
+
+    If `tile_height` is given, the leaves taller than it are split into tiles of `tile_height` rows plus `halo`
+    rows above and below, segmented separately and stitched (see `tile_bounds` and `stitch_tiles`), so that the
+    memory used to segment a leaf does not depend on its length.
+    """
+
+    uses_color_space = False
+    context_radius = 0
+
+    def __init__(self,
+                 tile_height: int = None,
+                 halo: int = TILE_HALO) -> None:
+        """
+        Parameters:
+            - tile_height (int, optional): The height of the tiles, None to segment the whole leaves. Defaults to None.
+            - halo (int, optional): The height of the halo of the tiles, at least the context radius of the
+                                    backend. Defaults to TILE_HALO.
+        """
+        if tile_height is not None and tile_height < 1:
+            raise ValueError(f"The height of the tiles must be a positive number of rows, got {tile_height}.")
+        if tile_height is not None and halo < self.context_radius:
+            raise ValueError(f"The halo of the tiles ({halo} px) must be at least the context radius of the backend ({self.context_radius} px).")
+        self.tile_height = tile_height
+        self.halo = halo
+
+    @abc.abstractmethod
+    def segment_directory(self,
+                          input_path: str,
+                          output_path: str) -> None:
+        """
+        Segments all the images of a directory and saves the label maps as '<name>_Simple_Segmentation.png'.
+
+        Parameters:
+            - input_path (str): The directory containing the images of the leaves.
+            - output_path (str): The directory where the label maps should be saved.
+        """
+
+
+class InProcessBackend(SegmentationBackend):
+    """
+    Base class of the backends segmenting the images in the current process.
+
+    The leaves, or the tiles of a leaf, are segmented by `segment_image` in SEGMENTATION_WORKERS threads.
+    """
+
+    @abc.abstractmethod
+    def segment_image(self,
+                      image: np.ndarray) -> np.ndarray:
+        """
+        Segments an image.
+
+        Parameters:
+            - image (numpy.ndarray): The image of the leaf.
+
+        Returns:
+            - numpy.ndarray: The label map, with the grey levels of CLASS_VALUES.
+        """
+
+    def segment_directory(self,
+                          input_path: str,
+                          output_path: str) -> None:
+        filenames = [filename for filename in sorted(os.listdir(input_path))
+                     if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS]
+
+        def segment_file(filename: str,
+                         executor: ThreadPoolExecutor = None) -> None:
+            image = cv2.imread(os.path.join(input_path, filename))
+
+            if executor is None or image.shape[0] <= self.tile_height:
+                label_map = self.segment_image(image)
+            else:
+                bounds = tile_bounds(image.shape[0], self.tile_height, self.halo)
+                label_maps = executor.map(lambda bound: self.segment_image(image[bound[0]:bound[1]]), bounds)
+                label_map = stitch_tiles(list(label_maps), bounds)
+
+            output_file = os.path.join(output_path, os.path.splitext(filename)[0] + SEGMENTATION_SUFFIX)
+            if not cv2.imwrite(output_file, label_map):
+                raise IOError(f"Could not write the image {output_file}.")
+
+        # OpenCV and NumPy release the GIL, so the leaves, or the tiles of a leaf, can be segmented in threads
+        with ThreadPoolExecutor(max_workers=SEGMENTATION_WORKERS) as executor:
+            if self.tile_height is None:
+                list(executor.map(segment_file, filenames))
+                return
+
+            # The leaves shorter than a tile (from the size in their header) are segmented whole in the threads,
+            # while the tiles of the longer leaves are segmented in the threads one leaf after the other
+            futures = []
+            for filename in filenames:
+                size = read_image_size(os.path.join(input_path, filename))
+                if size is not None and size[1] <= self.tile_height:
+                    futures.append(executor.submit(segment_file, filename))
+                else:
+                    segment_file(filename, executor)
+            for future in futures:
+                future.result()
+
+
+class IlastikBackend(SegmentationBackend):
+    """Segmentation with a trained Ilastik project (.ilp), run through EasIlastik."""
+
+    uses_color_space = True
+    context_radius = ILASTIK_CONTEXT_RADIUS
+
+    def __init__(self,
+                 model_path: str,
+                 tile_height: int = None,
+                 halo: int = TILE_HALO) -> None:
+        """
+        Parameters:
+            - model_path (str): The path to the Ilastik project.
+            - tile_height (int, optional): The height of the tiles, None to segment the whole leaves. Defaults to None.
+            - halo (int, optional): The height of the halo of the tiles. Defaults to TILE_HALO.
+        """
+        super().__init__(tile_height, halo)
+        self.model_path = model_path
+
+    def segment_directory(self,
+                          input_path: str,
+                          output_path: str) -> None:
+        from EasIlastik.run_ilastik import run_ilastik
+
+        if self.tile_height is None:
+            run_ilastik(input_path = input_path,
+                        model_path = self.model_path,
+                        result_base_path = output_path)
+            return
+
+        # Write the tiles of the leaves, segment them all in one run of Ilastik, then stitch them
+        tiles_path = os.path.join(output_path, TILES_DIR)
+        segmented_tiles_path = os.path.join(output_path, SEGMENTED_TILES_DIR) + '/'
+        os.makedirs(tiles_path, exist_ok=True)
+        os.makedirs(segmented_tiles_path, exist_ok=True)
+
+        leaves = []
+        for filename in sorted(os.listdir(input_path)):
+            if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                image = cv2.imread(os.path.join(input_path, filename))
+                bounds = tile_bounds(image.shape[0], self.tile_height, self.halo)
+                stem = os.path.splitext(filename)[0]
+                for k, (start, stop, _, _) in enumerate(bounds):
+                    cv2.imwrite(os.path.join(tiles_path, f"{stem}_tile{k}.png"), image[start:stop])
+                leaves.append((stem, bounds))
+
+        run_ilastik(input_path = tiles_path,
+                    model_path = self.model_path,
+                    result_base_path = segmented_tiles_path)
+
+        for stem, bounds in leaves:
+            label_maps = [cv2.imread(os.path.join(segmented_tiles_path, f"{stem}_tile{k}{SEGMENTATION_SUFFIX}"), cv2.IMREAD_GRAYSCALE)
+                          for k in range(len(bounds))]
+            cv2.imwrite(os.path.join(output_path, stem + SEGMENTATION_SUFFIX), stitch_tiles(label_maps, bounds))
+
+        shutil.rmtree(tiles_path)
+        shutil.rmtree(segmented_tiles_path)
+
+
+class PixelClassifierBackend(InProcessBackend):
+    """
+    Native segmentation with a pixel classifier over color-space features.
+
+    Each class is modelled by a multivariate Gaussian over the BGR, LAB, HSV, YUV and HLS channels of the pixels
+    (quadratic discriminant analysis), trained with `train_pixel_classifier`. The classification of a pixel only
+    depends on its own color, so the classifier runs fully vectorised and gives the same result on any crop.
+    """
+
+    def __init__(self,
+                 model_path: str,
+                 tile_height: int = None,
+                 halo: int = TILE_HALO) -> None:
+        """
+        Parameters:
+            - model_path (str): The path to the model (.npz) saved by `train_pixel_classifier`.
+            - tile_height (int, optional): The height of the tiles, None to segment the whole leaves. Defaults to None.
+            - halo (int, optional): The height of the halo of the tiles. Defaults to TILE_HALO.
+        """
+        super().__init__(tile_height, halo)
+        model = np.load(model_path)
+        self.means = model['means']
+        self.whitening = model['whitening']
+        self.log_norms = model['log_norms']
+        self.class_values = model['class_values'].astype(np.uint8)
+
+    def segment_image(self,
+                      image: np.ndarray) -> np.ndarray:
+        # The features are computed by chunks of rows, so that only the features of one chunk are in memory
+        chunk_rows = max(1, CLASSIFICATION_CHUNK_SIZE // max(1, image.shape[1]))
+
+        label_map = np.empty(image.shape[:2], dtype=np.uint8)
+        for start in range(0, image.shape[0], chunk_rows):
+            chunk = image[start:start + chunk_rows]
+            label_map[start:start + chunk_rows] = self.class_values[self._classify(pixel_features(chunk))].reshape(chunk.shape[:2])
+
+        return label_map
+
+    def _classify(self,
+                  features: np.ndarray) -> np.ndarray:
+        """Return the index of the most likely class of each pixel."""
+        log_likelihoods = np.empty((len(features), len(self.means)), dtype=np.float32)
+        for k, (mean, whitening) in enumerate(zip(self.means, self.whitening)):
+            whitened = (features - mean) @ whitening
+            log_likelihoods[:, k] = self.log_norms[k] - 0.5 * np.einsum('ij,ij->i', whitened, whitened)
+        return log_likelihoods.argmax(axis=1)
+
+
+BACKENDS = {
+    'ilastik': IlastikBackend,
+    'pixel': PixelClassifierBackend,
+}
+
+
+def get_backend(name: str,
+                model_path: str,
+                tile_height: int = None,
+                halo: int = TILE_HALO) -> SegmentationBackend:
+    """
+    Returns the segmentation backend of the given name.
+
+    Parameters:
+        - name (str): The name of the backend, one of BACKENDS.
+        - model_path (str): The path to the model of the backend.
+        - tile_height (int, optional): The height of the tiles, None to segment the whole leaves. Defaults to None.
+        - halo (int, optional): The height of the halo of the tiles. Defaults to TILE_HALO.
+
+    Returns:
+        - SegmentationBackend: The backend.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown segmentation backend '{name}', expected one of {list(BACKENDS)}.")
+    return BACKENDS[name](model_path, tile_height, halo)
+
+
+def tile_bounds(height: int,
+                tile_height: int,
+                halo: int) -> list[tuple]:
+    """
+    Splits the rows of an image into overlapping tiles.
+
+    Parameters:
+        - height (int): The height of the image.
+        - tile_height (int): The height of the tiles, without their halo.
+        - halo (int): The number of rows added above and below each tile (within the image).
+
+    Returns:
+        - list: A list of tuples (start, stop, top, bottom): the rows [start, stop) of the tile with its halo and
+                the rows [top, bottom) of the image kept from this tile.
+    """
+    bounds = []
+    for top in range(0, height, tile_height):
+        bottom = min(top + tile_height, height)
+        bounds.append((max(0, top - halo), min(height, bottom + halo), top, bottom))
+    return bounds
+
+
+def stitch_tiles(label_maps: list[np.ndarray],
+                 bounds: list[tuple]) -> np.ndarray:
+    """
+    Stitches the label maps of overlapping tiles, trimming their halo.
+
+    Parameters:
+        - label_maps (list): The label maps of the tiles, with their halo.
+        - bounds (list): The bounds of the tiles, as returned by `tile_bounds`.
+
+    Returns:
+        - numpy.ndarray: The label map of the whole image.
+    """
+    height = bounds[-1][3]
+    stitched = np.empty((height,) + label_maps[0].shape[1:], dtype=label_maps[0].dtype)
+    for label_map, (start, _, top, bottom) in zip(label_maps, bounds):
+        stitched[top:bottom] = label_map[top - start:bottom - start]
+    return stitched
+
+
+def pixel_features(image: np.ndarray) -> np.ndarray:
+    """
+    Computes the color-space features of the pixels of a BGR image.
+
+    Parameters:
+        - image (numpy.ndarray): The BGR image.
+
+    Returns:
+        - numpy.ndarray: A float32 array of shape (height * width, 3 * (1 + len(FEATURE_COLOR_SPACES))).
+    """
+    channels = [image] + [cv2.cvtColor(image, COLOR_SPACE_CONVERSIONS[color_space]) for color_space in FEATURE_COLOR_SPACES]
+    return np.concatenate(channels, axis=2).reshape(-1, 3 * len(channels)).astype(np.float32)
+
+
+def train_pixel_classifier(image_paths: list[str],
+                           label_paths: list[str],
+                           model_path: str,
+                           class_values: list[int] = CLASS_VALUES) -> None:
+    """
+    Trains the pixel classifier of `PixelClassifierBackend` from label images exported from Ilastik.
+
+    The label images give for each pixel 0 if it is not labelled, or the index (from 1) of its class in
+    `class_values`, which is the format of the labels exported by Ilastik. The statistics of the classes are
+    accumulated image by image, so the training set does not need to fit in memory.
+
+    Parameters:
+        - image_paths (list): The paths to the BGR images of the leaves (not converted to another color space).
+        - label_paths (list): The paths to the corresponding label images.
+        - model_path (str): The path where the model (.npz) should be saved.
+        - class_values (list, optional): The grey levels of the classes in the label maps. Defaults to CLASS_VALUES.
+    """
+    n_classes = len(class_values)
+    n_features = 3 * (1 + len(FEATURE_COLOR_SPACES))
+    counts = np.zeros(n_classes)
+    sums = np.zeros((n_classes, n_features))
+    products = np.zeros((n_classes, n_features, n_features))
+
+    for image_path, label_path in zip(image_paths, label_paths):
+        features = pixel_features(cv2.imread(image_path)).astype(np.float64)
+        labels = cv2.imread(label_path, cv2.IMREAD_UNCHANGED).reshape(-1)
+
+        for k in range(n_classes):
+            class_features = features[labels == k + 1]
+            counts[k] += len(class_features)
+            sums[k] += class_features.sum(axis=0)
+            products[k] += class_features.T @ class_features
+
+    if np.any(counts < 2):
+        raise ValueError(f"Every class needs labelled pixels, got {counts.astype(int).tolist()} pixels per class.")
+
+    # Gaussian of each class, stored as its mean, the whitening matrix W (with W W^T the inverse of the
+    # covariance matrix) and the log of its normalisation constant plus the log of the prior of the class
+    means = sums / counts[:, None]
+    whitening = np.empty_like(products)
+    log_norms = np.empty(n_classes)
+    for k in range(n_classes):
+        covariance = products[k] / counts[k] - np.outer(means[k], means[k])
+        covariance += COVARIANCE_REGULARIZATION * np.trace(covariance) / n_features * np.eye(n_features)
+        cholesky = np.linalg.cholesky(covariance)
+        whitening[k] = np.linalg.inv(cholesky).T
+        log_norms[k] = np.log(counts[k] / counts.sum()) - np.log(np.diag(cholesky)).sum()
+
+    np.savez(model_path,
+             means=means.astype(np.float32),
+             whitening=whitening.astype(np.float32),
+             log_norms=log_norms.astype(np.float32),
+             class_values=np.asarray(class_values))
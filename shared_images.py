@@ -0,0 +1,284 @@
+"""
+Shared Images Module
+---------------------
+
+Description:
+This file contains the shared-memory buffer pool used to pass the leaves of the decoded scans to worker processes,
+and the executor running a function on these leaves in spawned worker processes. Only the leaf regions of a scan are
+copied to its buffer, once. The workers receive crop descriptors (the name of the buffer and the position of a leaf
+in it) and read the crops directly from the shared memory.
+
+Authors: LE GOURRIEREC Titouan, CONNESSON Léna, PROUVOST Axel
+Date: 04/06/2024
+"""
+
+import multiprocessing
+import threading
+import uuid
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import NamedTuple
+
+import numpy as np
+
+########################################################################################################
+############################           Parameters & Constants              #############################
+########################################################################################################
+
+# Maximum number of scans whose leaves are held in shared memory at the same time
+MAX_SHARED_BUFFERS = 2
+
+BUFFER_NAME_PREFIX = 'leaf_scan_'
+
+########################################################################################################
+############################                 Main Functions                 #############################
+########################################################################################################
+
+class CropDescriptor(NamedTuple):
+    """Description of a leaf crop of a scan held in shared memory, cheap to send to a worker process."""
+    buffer_name: str
+    offset: int # position of the crop in the buffer, in bytes
+    shape: tuple
+    dtype: str
+
+
+class SharedImagePool:
+    """
+    Pool of shared-memory buffers holding the leaves of decoded scans.
+
+    The leaves of each scan are put in a buffer with one user per leaf. The buffer is returned to the
+    pool once every user has called `release`, and is then reused for a next scan of the same size or smaller.
+    `put` blocks while MAX_SHARED_BUFFERS buffers are in use, which bounds the memory used by the pool.
+
+    Usage:
+        with SharedImagePool() as pool:
+            descriptors = pool.put(image, bounding_boxes)
+            # send the descriptors to the workers, then call pool.release(descriptor.buffer_name) for each one
+    """
+
+    def __init__(self,
+                 max_buffers: int = MAX_SHARED_BUFFERS) -> None:
+        """
+        Parameters:
+            - max_buffers (int, optional): The maximum number of buffers in use at the same time. Defaults to MAX_SHARED_BUFFERS.
+        """
+        self.max_buffers = max_buffers
+
+        self._condition = threading.Condition()
+        self._buffers = {}   # name -> SharedMemory
+        self._users = {}     # name -> number of users, for the buffers in use
+        self._free = []      # names of the buffers not in use
+
+    def put(self,
+            image: np.ndarray,
+            bounding_boxes: np.ndarray) -> list[CropDescriptor]:
+        """
+        Copies the crops of an image to a shared buffer and returns their descriptors.
+
+        The buffer is in use until `release` has been called once per bounding box. If there is no bounding box,
+        nothing is copied.
+
+        Parameters:
+            - image (numpy.ndarray): The image whose crops are shared.
+            - bounding_boxes (numpy.ndarray): The bounding boxes (x1, y1, x2, y2) of the crops.
+
+        Returns:
+            - list: The descriptors of the crops, one per bounding box.
+        """
+        if len(bounding_boxes) == 0:
+            return []
+
+        height, width = image.shape[:2]
+        crops = [image[max(0, int(y1)):min(height, int(y2)), max(0, int(x1)):min(width, int(x2))]
+                 for x1, y1, x2, y2 in bounding_boxes]
+
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._users) < self.max_buffers)
+            shm = self._acquire(max(1, sum(crop.nbytes for crop in crops)))
+            self._users[shm.name] = len(crops)
+
+        descriptors = []
+        offset = 0
+        for crop in crops:
+            np.ndarray(crop.shape, dtype=crop.dtype, buffer=shm.buf, offset=offset)[...] = crop
+            descriptors.append(CropDescriptor(shm.name, offset, crop.shape, crop.dtype.str))
+            offset += crop.nbytes
+
+        return descriptors
+
+    def release(self,
+                buffer_name: str) -> None:
+        """
+        Releases one use of a buffer. The buffer returns to the pool when all its users have released it.
+
+        Parameters:
+            - buffer_name (str): The name of the buffer.
+        """
+        with self._condition:
+            self._users[buffer_name] -= 1
+            if self._users[buffer_name] == 0:
+                del self._users[buffer_name]
+                self._free.append(buffer_name)
+                self._condition.notify_all()
+
+    def close(self) -> None:
+        """Frees all the buffers. The buffers must not be in use anymore."""
+        with self._condition:
+            if self._users:
+                raise RuntimeError(f"{len(self._users)} shared buffers are still in use.")
+            for shm in self._buffers.values():
+                shm.close()
+                shm.unlink()
+            self._buffers = {}
+            self._free = []
+
+    def __enter__(self) -> 'SharedImagePool':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _acquire(self,
+                 size: int) -> shared_memory.SharedMemory:
+        """Return a free buffer of at least `size` bytes, replacing a too small free buffer if needed."""
+        for name in self._free:
+            if self._buffers[name].size >= size:
+                self._free.remove(name)
+                return self._buffers[name]
+
+        # Free the smallest free buffer if the pool is full, then create a new buffer
+        if self._free and len(self._buffers) >= self.max_buffers:
+            name = min(self._free, key=lambda name: self._buffers[name].size)
+            self._free.remove(name)
+            shm = self._buffers.pop(name)
+            shm.close()
+            shm.unlink()
+
+        shm = shared_memory.SharedMemory(name=BUFFER_NAME_PREFIX + uuid.uuid4().hex, create=True, size=size)
+        self._buffers[shm.name] = shm
+        return shm
+
+
+class CropExecutor:
+    """
+    Runs a function on the crops of images in spawned worker processes, which read them from a SharedImagePool.
+
+    The crops are tagged, e.g. with the scan they belong to, and `settle` waits for the crops of a tag and raises
+    their first error, so that the crops of a scan are processed while the next scans are being processed. A worker
+    process which dies only fails the crops being processed, the pool of workers being then replaced.
+
+    Usage:
+        executor = CropExecutor(function)
+        executor.submit(1, image, bounding_boxes, [(output_path,) for output_path in output_paths])
+        ...
+        executor.settle(1)  # raises the first error of function(descriptor, output_path) for the crops tagged 1
+        executor.close()
+    """
+
+    def __init__(self,
+                 function: callable,
+                 max_workers: int = None,
+                 max_buffers: int = MAX_SHARED_BUFFERS) -> None:
+        """
+        Parameters:
+            - function (callable): The function, defined at the top level of a module, called with the descriptor
+                                   of a crop followed by its arguments.
+            - max_workers (int, optional): The number of worker processes. Defaults to None (the number of CPUs).
+            - max_buffers (int, optional): The maximum number of images in shared memory. Defaults to MAX_SHARED_BUFFERS.
+        """
+        self.function = function
+        self.max_workers = max_workers
+
+        self._shared_pool = SharedImagePool(max_buffers)
+        self._executor = self._new_executor()
+        self._futures = {} # tag -> futures of the crops of the tag
+
+    def submit(self,
+               tag: object,
+               image: np.ndarray,
+               bounding_boxes: np.ndarray,
+               args: list[tuple]) -> None:
+        """
+        Shares the crops of an image and submits them to the worker processes. Blocks while MAX_SHARED_BUFFERS
+        images have crops being processed.
+
+        Parameters:
+            - tag (hashable): The tag of the crops.
+            - image (numpy.ndarray): The image.
+            - bounding_boxes (numpy.ndarray): The bounding boxes (x1, y1, x2, y2) of the crops.
+            - args (list): The arguments of the function for each crop.
+        """
+        descriptors = self._shared_pool.put(image, bounding_boxes)
+        futures = self._futures.setdefault(tag, [])
+
+        submitted = 0
+        try:
+            for descriptor, crop_args in zip(descriptors, args):
+                future = self._submit(descriptor, crop_args)
+                future.add_done_callback(lambda _, name=descriptor.buffer_name: self._shared_pool.release(name))
+                futures.append(future)
+                submitted += 1
+        finally:
+            # The crops which were not submitted do not use the buffer
+            for descriptor in descriptors[submitted:]:
+                self._shared_pool.release(descriptor.buffer_name)
+
+    def settle(self,
+               tag: object) -> None:
+        """
+        Waits until all the crops of a tag are processed, raising the first error encountered on them.
+
+        Parameters:
+            - tag (hashable): The tag of the crops.
+        """
+        futures = self._futures.pop(tag, [])
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def close(self) -> None:
+        """Waits for the crops being processed, stops the worker processes and frees the shared memory."""
+        self._executor.shutdown()
+        self._futures = {}
+        self._shared_pool.close()
+
+    def __enter__(self) -> 'CropExecutor':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        """Return a pool of spawned worker processes (forking while other threads run could deadlock them)."""
+        return ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _submit(self,
+                descriptor: CropDescriptor,
+                crop_args: tuple) -> Future:
+        """Submit a crop, replacing the pool of workers if one of them died."""
+        try:
+            return self._executor.submit(self.function, descriptor, *crop_args)
+        except BrokenProcessPool:
+            self._executor.shutdown()
+            self._executor = self._new_executor()
+            return self._executor.submit(self.function, descriptor, *crop_args)
+
+
+def open_crop(descriptor: CropDescriptor) -> tuple:
+    """
+    Attaches to the shared buffer of a crop, in a worker process.
+
+    Parameters:
+        - descriptor (CropDescriptor): The descriptor of the crop.
+
+    Returns:
+        - tuple: The crop (a view of the shared buffer, without copy) and the attached shared memory, which must
+                 be closed with `shm.close()` once the crop is not used anymore.
+    """
+    shm = shared_memory.SharedMemory(name=descriptor.buffer_name)
+    crop = np.ndarray(descriptor.shape, dtype=np.dtype(descriptor.dtype), buffer=shm.buf, offset=descriptor.offset)
+
+    return crop, shm
@@ -0,0 +1,130 @@
+"""
+Shared fixtures of the tests: synthetic scans with known leaves, recorded OCR detections and label maps with
+known areas. Everything is generated or read from tests/fixtures, so the tests run without GPU, network,
+OCR models or Ilastik.
+"""
+
+import json
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures')
+sys.path.insert(0, ROOT)
+
+
+def load_fixture(name: str):
+    """Load a JSON fixture of tests/fixtures."""
+    with open(os.path.join(FIXTURES, name)) as file:
+        return json.load(file)
+
+
+def make_scan(height: int,
+              width: int,
+              leaves: list[tuple],
+              seed: int = 0) -> np.ndarray:
+    """
+    Make a synthetic scan: a noisy white background with dark green leaves.
+
+    Parameters:
+        - height (int): The height of the scan.
+        - width (int): The width of the scan.
+        - leaves (list): The leaves, as rectangles (x1, y1, x2, y2).
+        - seed (int, optional): The seed of the noise.
+
+    Returns:
+        - numpy.ndarray: The BGR scan.
+    """
+    rng = np.random.default_rng(seed)
+    scan = np.full((height, width, 3), 250, dtype=np.uint8)
+    for x1, y1, x2, y2 in leaves:
+        scan[y1:y2, x1:x2] = (40, 120, 50)
+    noise = rng.integers(-5, 6, size=scan.shape)
+    return np.clip(scan.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def make_label_map(areas: dict,
+                   width: int = 100) -> np.ndarray:
+    """
+    Make a label map with a known number of pixels of each grey level, laid out in horizontal bands.
+
+    Parameters:
+        - areas (dict): The number of pixels of each grey level.
+        - width (int, optional): The width of the label map.
+
+    Returns:
+        - numpy.ndarray: The grayscale label map.
+    """
+    pixels = np.concatenate([np.full(count, value, dtype=np.uint8) for value, count in areas.items()])
+    height = -(-len(pixels) // width)
+    padding = np.full(height * width - len(pixels), 63, dtype=np.uint8)
+    return np.concatenate([pixels, padding]).reshape(height, width)
+
+
+class RecordedReader:
+    """OCR reader replaying recorded EasyOCR detections."""
+
+    def __init__(self, detections: list) -> None:
+        self.detections = [(bbox, text, confidence) for bbox, text, confidence in detections]
+
+    def readtext(self, img: np.ndarray) -> list:
+        return self.detections
+
+    def detect(self, img: np.ndarray) -> tuple:
+        # No text localised, the text is read on the whole scan
+        return [[]], [[]]
+
+
+@pytest.fixture(scope='session')
+def scan_cases() -> list[dict]:
+    """Synthetic scans and their golden bounding boxes."""
+    cases = load_fixture('leaf_boxes.json')
+    for case in cases:
+        case['image'] = make_scan(case['height'], case['width'], case['leaves'])
+    return cases
+
+
+@pytest.fixture(scope='session')
+def detection_cases() -> list[dict]:
+    """Recorded EasyOCR detections and their golden R, P, code_champ, M and EPO."""
+    return load_fixture('detections.json')
+
+
+@pytest.fixture(scope='session')
+def label_map_cases() -> list[dict]:
+    """Label maps with known areas."""
+    cases = load_fixture('label_maps.json')
+    for case in cases:
+        case['image'] = make_label_map({int(value): count for value, count in case['pixels'].items()})
+    return cases
+
+
+@pytest.fixture
+def segmented_leaves(tmp_path, label_map_cases) -> tuple:
+    """A directory of segmented leaves and the dataframe of the corresponding leaves."""
+    import pandas as pd
+
+    names = []
+    for k, case in enumerate(label_map_cases):
+        name = f"{k + 1}_leaf1.png"
+        cv2.imwrite(str(tmp_path / (os.path.splitext(name)[0] + '_Simple_Segmentation.png')), case['image'])
+        names.append(name)
+
+    return str(tmp_path), pd.DataFrame({'New_File_Name': names})
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: timing budget of a function (see tests/test_performance.py)')
+
+
+def pytest_terminal_summary(terminalreporter):
+    test_performance = sys.modules.get('test_performance')
+
+    if test_performance is not None and test_performance.TIMINGS:
+        terminalreporter.section('timing budgets')
+        for name, (best, budget) in sorted(test_performance.TIMINGS.items()):
+            terminalreporter.write_line(f"{name:<40} {best:9.4f}s / {budget}s")
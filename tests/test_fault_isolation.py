@@ -0,0 +1,167 @@
+import os
+import time
+
+import cv2
+import pandas as pd
+import pytest
+
+import image_writer
+import main
+import text_detection
+from conftest import RecordedReader
+from conftest import make_scan
+from fault_isolation import IsolatedRunner
+from fault_isolation import ScanTimeoutError
+from fault_isolation import dead_letter
+from fault_isolation import log_error
+from fault_isolation import run_with_retries
+from main import save_leaves
+from utils import convert_crop_color_space
+
+
+def square(x):
+    return x * x
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+def failing_conversion(descriptor, path, color_space):
+    if os.path.basename(path).endswith('_leaf2.png'):
+        raise ValueError(f"cannot convert {os.path.basename(path)}")
+    return convert_crop_color_space(descriptor, path, color_space)
+
+
+def write_scans(input_directory, leaves):
+    input_directory.mkdir()
+    for k, (filename, scan_leaves) in enumerate(leaves.items()):
+        cv2.imwrite(str(input_directory / filename), make_scan(12000, 1400, scan_leaves, seed=k))
+    return input_directory
+
+
+def test_run_with_retries_recovers_from_a_failure():
+    attempts = []
+
+    def flaky():
+        attempts.append(len(attempts) + 1)
+        if len(attempts) == 1:
+            raise IOError("first attempt")
+        return 'done'
+
+    failures = []
+    result, errors = run_with_retries(flaky, (), max_retries=1, retry_delay=0,
+                                      on_failure=lambda attempt, error: failures.append(attempt))
+
+    assert (result, errors) == ('done', None)
+    assert failures == [1]
+
+
+def test_run_with_retries_gives_up():
+    result, errors = run_with_retries(fail, ("corrupt",), max_retries=2, retry_delay=0)
+
+    assert result is None
+    assert [str(error) for error in errors] == ["corrupt"] * 3
+
+
+def test_isolated_runner_timeout_and_errors():
+    with IsolatedRunner() as runner:
+        assert runner.run(square, (4,), timeout=30) == 16
+
+        with pytest.raises(ScanTimeoutError):
+            runner.run(sleep, (30,), timeout=1)
+
+        # A new worker replaces the stuck one
+        assert runner.run(square, (5,), timeout=30) == 25
+
+        with pytest.raises(ValueError, match="corrupt"):
+            runner.run(fail, ("corrupt",), timeout=30)
+
+
+def test_dead_letter_and_error_log(tmp_path):
+    scan = tmp_path / 'scan.jpg'
+    scan.write_bytes(b'\xff\xd8 corrupt')
+
+    dead_letter(str(scan), str(tmp_path / 'Dead_Letter'))
+    log_error(str(tmp_path / 'errors.csv'), 'scan.jpg', 1, ValueError("cannot be decoded"))
+    log_error(str(tmp_path / 'errors.csv'), 'scan.jpg', 2, ValueError("cannot be decoded"))
+
+    assert (tmp_path / 'Dead_Letter' / 'scan.jpg').read_bytes() == scan.read_bytes()
+    assert (tmp_path / 'errors.csv').read_text().splitlines() == [
+        'Original_File_Name,Attempt,Error,Message',
+        'scan.jpg,1,ValueError,cannot be decoded',
+        'scan.jpg,2,ValueError,cannot be decoded',
+    ]
+
+
+@pytest.mark.parametrize('failing_leaf, failures, expected_scans, expected_errors', [
+    # A transient failure of the first scan, detected once the second scan is processed: the scan is processed again
+    ('1_leaf1.png', 1, ['a.jpg', 'b.jpg', 'c.jpg'], [['a.jpg', 1]]),
+    # A persistent failure of the first scan: its label is given to the next scans
+    ('1_leaf1.png', 2, ['b.jpg', 'c.jpg'], [['a.jpg', 1], ['a.jpg', 2]]),
+    # A persistent failure of the last scan, detected after the loop
+    ('3_leaf1.png', 2, ['a.jpg', 'b.jpg'], [['c.jpg', 1], ['c.jpg', 2]]),
+])
+def test_failed_write_fails_its_scan(tmp_path, monkeypatch, detection_cases,
+                                     failing_leaf, failures, expected_scans, expected_errors):
+    widths = {'a.jpg': 500, 'b.jpg': 600, 'c.jpg': 700}
+    input_directory = write_scans(tmp_path / 'input', {filename: [(200, 1000, 200 + width, 9000)]
+                                                       for filename, width in widths.items()})
+    monkeypatch.setattr(text_detection, 'READER', RecordedReader(detection_cases[0]['detections']))
+
+    # The failing leaf cannot be written the first `failures` times
+    encode_and_write = image_writer._encode_and_write
+    attempts = []
+
+    def failing_encode_and_write(path, *args):
+        if path.endswith(os.sep + failing_leaf) and len(attempts) < failures:
+            attempts.append(path)
+            raise OSError(f"disk error on {path}")
+        return encode_and_write(path, *args)
+
+    monkeypatch.setattr(image_writer, '_encode_and_write', failing_encode_and_write)
+
+    results_path, file_path, _, labels_path, results, _, _ = save_leaves(str(input_directory), str(tmp_path),
+                                                                         scan_timeout=None)
+
+    labels = list(range(1, len(expected_scans) + 1))
+    assert results[['Original_File_Name', 'New_File_Name', 'Label', 'Label_Snapshot']].values.tolist() == [
+        [filename, f"{label}_leaf1.png", label, f"Labels_{label}.jpg"] for filename, label in zip(expected_scans, labels)]
+    assert sorted(os.listdir(file_path)) == [f"{label}_leaf1.png" for label in labels]
+    assert sorted(os.listdir(labels_path)) == [f"Labels_{label}.jpg" for label in labels]
+
+    # The leaves are those of their scan (recognised by their width), after the renumbering of the labels
+    for filename, label in zip(expected_scans, labels):
+        leaf = cv2.imread(os.path.join(file_path, f"{label}_leaf1.png"))
+        assert abs(leaf.shape[1] - widths[filename]) < 20, filename
+
+    errors = pd.read_csv(os.path.join(results_path, 'errors.csv'))
+    assert errors[['Original_File_Name', 'Attempt']].values.tolist() == expected_errors
+    assert set(errors['Error']) == {'OSError'}
+    dead_letter_path = os.path.join(results_path, 'Dead_Letter')
+    dead_letters = os.listdir(dead_letter_path) if os.path.isdir(dead_letter_path) else []
+    assert dead_letters == ([expected_errors[0][0]] if failures > 1 else [])
+
+
+def test_failed_conversion_fails_its_scan(tmp_path, monkeypatch, detection_cases):
+    input_directory = write_scans(tmp_path / 'input', {'a.jpg': [(100, 1000, 600, 9000), (800, 1000, 1300, 9000)],
+                                                       'b.jpg': [(200, 1000, 800, 9000)]})
+    monkeypatch.setattr(text_detection, 'READER', RecordedReader(detection_cases[0]['detections']))
+
+    # The second leaf of the first scan cannot be converted, in the worker processes reading them from the shared memory
+    monkeypatch.setattr(main, 'convert_crop_color_space', failing_conversion)
+
+    results_path, file_path, _, _, results, _, _ = save_leaves(str(input_directory), str(tmp_path), color_space='LAB',
+                                                               scan_timeout=None, max_retries=0)
+
+    # The failed scan does not use a label, the next scan takes it
+    assert results[['Original_File_Name', 'New_File_Name', 'Label']].values.tolist() == [['b.jpg', '1_leaf1.png', 1]]
+    assert os.listdir(file_path) == ['1_leaf1.png']
+    assert os.listdir(os.path.join(results_path, 'Dead_Letter')) == ['a.jpg']
+    errors = pd.read_csv(os.path.join(results_path, 'errors.csv'))
+    assert errors.values.tolist() == [['a.jpg', 1, 'ValueError', 'cannot convert 1_leaf2.png']]
+    assert os.listdir(os.path.join(results_path, 'color_space')) == ['1_leaf1.png']
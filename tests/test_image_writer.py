@@ -0,0 +1,123 @@
+import os
+import threading
+
+import cv2
+import numpy as np
+import pytest
+
+import image_writer
+from image_writer import ImageWriter
+
+
+def test_flush_is_a_barrier(tmp_path):
+    writer = ImageWriter(max_pending=2, workers=2, fsync=False)
+    image = np.full((20, 30, 3), 100, dtype=np.uint8)
+    paths = [str(tmp_path / f"{k}.png") for k in range(10)]
+    for path in paths:
+        writer.write(path, image)
+
+    writer.flush()
+
+    assert all(np.array_equal(cv2.imread(path), image) for path in paths)
+    writer.close()
+
+    metrics = writer.metrics()
+    assert metrics['images'] == 10
+    assert metrics['bytes'] == sum(os.path.getsize(path) for path in paths)
+    assert metrics['max_queue_depth'] <= 2
+
+
+def test_write_blocks_when_the_queue_is_full(tmp_path, monkeypatch):
+    release = threading.Event()
+    encode_and_write = image_writer._encode_and_write
+
+    def blocked_encode_and_write(*args):
+        release.wait()
+        return encode_and_write(*args)
+
+    monkeypatch.setattr(image_writer, '_encode_and_write', blocked_encode_and_write)
+    writer = ImageWriter(max_pending=2, workers=1, fsync=False)
+    image = np.zeros((5, 5), dtype=np.uint8)
+
+    # One image held by the worker, two in the queue, the fourth write must block
+    for k in range(3):
+        writer.write(str(tmp_path / f"{k}.png"), image)
+    blocked_write = threading.Thread(target=writer.write, args=(str(tmp_path / '3.png'), image))
+    blocked_write.start()
+    blocked_write.join(0.3)
+    assert blocked_write.is_alive()
+
+    release.set()
+    blocked_write.join(5)
+    assert not blocked_write.is_alive()
+    writer.close()
+    assert len(os.listdir(tmp_path)) == 4
+
+
+@pytest.mark.parametrize('raised_by', ['write', 'flush', 'close'])
+def test_worker_errors_are_raised(tmp_path, raised_by):
+    writer = ImageWriter(workers=1, fsync=False)
+    writer.write(str(tmp_path / 'missing_directory' / 'leaf.png'), np.zeros((5, 5), dtype=np.uint8))
+
+    with pytest.raises(FileNotFoundError):
+        if raised_by == 'write':
+            # The error is raised by the next write once the failed image has been processed
+            for _ in range(100):
+                writer.write(str(tmp_path / 'next.png'), np.zeros((5, 5), dtype=np.uint8))
+                writer._queue.join()
+        elif raised_by == 'flush':
+            writer.flush()
+        else:
+            writer.close()
+    writer.close()
+
+
+def test_tagged_errors_are_raised_by_settle(tmp_path):
+    writer = ImageWriter(workers=2, fsync=False)
+    image = np.zeros((5, 5), dtype=np.uint8)
+    writer.write(str(tmp_path / 'missing_directory' / '1_leaf1.png'), image, tag=1)
+    writer.write(str(tmp_path / '1_leaf2.png'), image, tag=1)
+    writer.write(str(tmp_path / '2_leaf1.png'), image, tag=2)
+
+    # The error of the first scan is only raised when it is settled
+    writer.flush()
+    writer.write(str(tmp_path / 'contact_sheet.png'), image)
+    metrics = writer.settle(2)
+    assert metrics['images'] == 1 and metrics['bytes'] == os.path.getsize(tmp_path / '2_leaf1.png')
+    with pytest.raises(FileNotFoundError):
+        writer.settle(1)
+    assert writer.settle(1) == {'images': 0, 'bytes': 0, 'encode_time': 0.0}
+
+    writer.close()
+    assert sorted(os.listdir(tmp_path)) == ['1_leaf2.png', '2_leaf1.png', 'contact_sheet.png']
+    assert writer.metrics()['images'] == 3
+
+
+def test_settle_waits_for_the_images_of_its_tag(tmp_path, monkeypatch):
+    release = threading.Event()
+    encode_and_write = image_writer._encode_and_write
+
+    def blocked_encode_and_write(path, *args):
+        if path.endswith('2.png'):
+            release.wait()
+        return encode_and_write(path, *args)
+
+    monkeypatch.setattr(image_writer, '_encode_and_write', blocked_encode_and_write)
+    writer = ImageWriter(workers=2, fsync=False)
+    image = np.zeros((5, 5), dtype=np.uint8)
+    writer.write(str(tmp_path / '1.png'), image, tag=1)
+    writer.write(str(tmp_path / '2.png'), image, tag=2)
+
+    # The scan 1 is settled while the image of the scan 2 is still being written
+    writer.settle(1)
+    assert os.listdir(tmp_path) == ['1.png']
+
+    blocked_settle = threading.Thread(target=writer.settle, args=(2,))
+    blocked_settle.start()
+    blocked_settle.join(0.3)
+    assert blocked_settle.is_alive()
+
+    release.set()
+    blocked_settle.join(5)
+    assert not blocked_settle.is_alive()
+    writer.close()
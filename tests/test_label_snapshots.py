@@ -0,0 +1,71 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from image_writer import ImageWriter
+from label_snapshots import LabelSnapshotWriter
+from label_snapshots import contact_sheet
+from label_snapshots import encoding_parameters
+from label_snapshots import thumbnail
+from main import save_leaves
+
+
+def test_encoding_parameters():
+    assert encoding_parameters('.JPG', 80) == [cv2.IMWRITE_JPEG_QUALITY, 80]
+    assert encoding_parameters('.webp', 80) == [cv2.IMWRITE_WEBP_QUALITY, 80]
+
+    # The quality is mapped to a compression level, from 9 (quality 0) to 0 (quality 100)
+    levels = [encoding_parameters('.png', quality)[1] for quality in (0, 50, 90, 100)]
+    assert levels == [9, 4, 1, 0]
+
+    with pytest.raises(ValueError, match="Unsupported label format '.bmp'"):
+        encoding_parameters('.bmp', 90)
+    with pytest.raises(ValueError, match="from 0 to 100"):
+        encoding_parameters('.jpg', 101)
+
+
+def test_invalid_label_format_fails_before_the_workspace(tmp_path):
+    (tmp_path / 'input').mkdir()
+
+    with pytest.raises(ValueError, match="Unsupported label format"):
+        save_leaves(str(tmp_path / 'input'), str(tmp_path / 'output'), label_format='.bmp')
+    assert not (tmp_path / 'output').exists()
+
+
+def test_thumbnail_keeps_the_aspect_ratio():
+    image = np.zeros((100, 400, 3), dtype=np.uint8)
+
+    assert thumbnail(image, (256, 128)).shape == (64, 256)
+    assert thumbnail(image[:, :50], (256, 128)).shape == (128, 64)
+
+
+def test_contact_sheet_layout():
+    thumbnails = [(label_index, np.full((50, 100), 100, dtype=np.uint8)) for label_index in (1, 2, 7)]
+
+    sheet = contact_sheet(thumbnails, columns=2, cell_size=(120, 60))
+
+    # Two rows of two cells, each cell being a caption of 24 px above the thumbnail
+    assert sheet.shape == (2 * (60 + 24), 2 * 120)
+    for top, left in ((0, 0), (0, 120), (84, 0)):
+        assert np.all(sheet[top + 24:top + 74, left:left + 100] == 100)
+        assert np.any(sheet[top:top + 24, left:left + 120] < 128) # caption
+    assert np.all(sheet[84:, 120:] == 255) # empty cell
+
+
+def test_discarded_snapshots_are_not_in_the_contact_sheet(tmp_path):
+    image_writer = ImageWriter(fsync=False)
+    label_writer = LabelSnapshotWriter(image_writer, str(tmp_path), '.png', contact_sheet=True)
+    for label_index in (1, 2, 3):
+        label_writer.write(label_index, np.full((50, 100), 50 * label_index, dtype=np.uint8))
+
+    label_writer.discard(2)
+    assert label_writer.close() == ['Labels_contact_sheet_1.png']
+    image_writer.close()
+
+    assert sorted(os.listdir(tmp_path)) == ['Labels_1.png', 'Labels_2.png', 'Labels_3.png',
+                                            'Labels_contact_sheet_1.png']
+    sheet = cv2.imread(str(tmp_path / 'Labels_contact_sheet_1.png'), cv2.IMREAD_UNCHANGED)
+    cells = [sheet[24 + 64, 256 * k + 10] for k in range(3)]
+    assert cells == [50, 150, 255]
@@ -0,0 +1,57 @@
+import cv2
+import numpy as np
+
+from conftest import make_scan
+from leaf_detection import leaf_detection
+from leaf_detection import read_image_size
+from leaf_detection import screen_image
+
+
+def test_leaf_detection_golden_boxes(scan_cases):
+    for case in scan_cases:
+        boxes = leaf_detection(case['image'], reduction=case['reduction'])
+        assert boxes.tolist() == case['expected_boxes'], case['name']
+
+
+def test_leaf_detection_reduced_matches_full_resolution(scan_cases):
+    full = next(case for case in scan_cases if case['reduction'] == 1)
+    reduced = cv2.resize(full['image'], None, fx=1/4, fy=1/4, interpolation=cv2.INTER_AREA)
+
+    boxes = leaf_detection(reduced, reduction=4)
+
+    assert boxes.shape == (len(full['expected_boxes']), 4)
+    assert np.abs(boxes - np.array(full['expected_boxes'])).max() <= 8
+
+
+def test_read_image_size(tmp_path):
+    image = np.zeros((37, 53, 3), dtype=np.uint8)
+    for extension in ('.jpg', '.png'):
+        path = str(tmp_path / f"image{extension}")
+        cv2.imwrite(path, image)
+        assert read_image_size(path) == (53, 37)
+
+    progressive = str(tmp_path / 'progressive.jpg')
+    cv2.imwrite(progressive, image, [cv2.IMWRITE_JPEG_PROGRESSIVE, 1])
+    assert read_image_size(progressive) == (53, 37)
+
+    not_an_image = tmp_path / 'text.jpg'
+    not_an_image.write_text('not an image')
+    assert read_image_size(str(not_an_image)) is None
+
+
+def test_screen_image(tmp_path):
+    usable = str(tmp_path / 'usable.jpg')
+    cv2.imwrite(usable, make_scan(12000, 1000, [(200, 1000, 800, 9000)]))
+    assert screen_image(usable)[:2] == (True, None)
+
+    too_short = str(tmp_path / 'too_short.png')
+    cv2.imwrite(too_short, make_scan(500, 500, []))
+    assert screen_image(too_short)[0] is False
+
+    blank = str(tmp_path / 'blank.jpg')
+    cv2.imwrite(blank, np.full((12000, 1000, 3), 255, dtype=np.uint8))
+    assert screen_image(blank)[:2] == (False, "blank image")
+
+    leafless = str(tmp_path / 'leafless.jpg')
+    cv2.imwrite(leafless, make_scan(12000, 1000, [(100, 1000, 800, 1800)]))
+    assert screen_image(leafless)[:2] == (False, "no leaf")
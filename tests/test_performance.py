@@ -0,0 +1,79 @@
+"""
+Timing budgets of the critical functions, in seconds, read from tests/fixtures/timing_budgets.json. The best
+time of a few runs is compared to the budget and reported at the end of the session. Run only these tests with
+`pytest -m benchmark`, or skip them with `pytest -m "not benchmark"`.
+"""
+
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from conftest import RecordedReader
+from conftest import load_fixture
+from leaf_detection import leaf_detection
+from segmentation import PixelClassifierBackend
+from segmentation import train_pixel_classifier
+from text_detection import get_number_from_groups
+from text_detection import group_detections
+from text_detection import sort_detections
+from text_detection import text_detection
+from utils import leaves_analysis
+from utils import lesion_statistics
+
+BUDGETS = load_fixture('timing_budgets.json')
+TIMINGS = {}
+
+pytestmark = pytest.mark.benchmark
+
+
+def assert_within_budget(name: str, function, repeat: int = 3) -> None:
+    """Time the best of `repeat` runs of `function` and compare it to the budget `name`."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+
+    TIMINGS[name] = (best, BUDGETS[name])
+    assert best <= BUDGETS[name], f"{name} took {best:.4f}s, budget {BUDGETS[name]}s"
+
+
+def test_leaf_detection_budget(scan_cases):
+    full = next(case for case in scan_cases if case['reduction'] == 1)
+    reduced = next(case for case in scan_cases if case['reduction'] == 4)
+
+    assert_within_budget('leaf_detection_full_resolution', lambda: leaf_detection(full['image']), repeat=1)
+    assert_within_budget('leaf_detection_reduced', lambda: leaf_detection(reduced['image'], reduction=4))
+
+
+def test_text_parsing_budget(detection_cases):
+    detections = [tuple(detection) for case in detection_cases for detection in case['detections']] * 20
+    groups = group_detections(sort_detections(detections), threshold=100)
+    image = np.full((1000, 400, 3), 255, dtype=np.uint8)
+    reader = RecordedReader(detection_cases[0]['detections'])
+
+    assert_within_budget('sort_and_group_detections', lambda: group_detections(sort_detections(detections), threshold=100))
+    assert_within_budget('get_number_from_groups', lambda: get_number_from_groups(groups, ['code', 'champ']))
+    assert_within_budget('text_detection_recorded', lambda: text_detection(image, reader=reader))
+
+
+def test_analysis_budget(segmented_leaves):
+    segmented_leaves_path, results_dataframe = segmented_leaves
+    mask_path = f"{segmented_leaves_path}/2_leaf1_Simple_Segmentation.png"
+
+    assert_within_budget('leaves_analysis', lambda: leaves_analysis(results_dataframe, segmented_leaves_path, 1.0))
+    assert_within_budget('lesion_statistics', lambda: lesion_statistics(mask_path, 1.0))
+
+
+def test_pixel_classifier_budget(tmp_path):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, size=(1000, 1000, 3), dtype=np.uint8)
+    labels = rng.integers(0, 5, size=(1000, 1000), dtype=np.uint8)
+    cv2.imwrite(str(tmp_path / 'image.png'), image)
+    cv2.imwrite(str(tmp_path / 'labels.png'), labels)
+    train_pixel_classifier([str(tmp_path / 'image.png')], [str(tmp_path / 'labels.png')], str(tmp_path / 'model.npz'))
+    backend = PixelClassifierBackend(str(tmp_path / 'model.npz'))
+
+    assert_within_budget('pixel_classifier_1_megapixel', lambda: backend.segment_image(image))
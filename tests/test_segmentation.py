@@ -0,0 +1,115 @@
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+
+import segmentation
+from segmentation import CLASS_VALUES
+from segmentation import InProcessBackend
+from segmentation import PixelClassifierBackend
+from segmentation import stitch_tiles
+from segmentation import tile_bounds
+from segmentation import train_pixel_classifier
+from utils import leaves_analysis
+
+
+class BlurBackend(InProcessBackend):
+    """Backend whose labels depend on a neighbourhood of 5 rows, to check the halo trimming."""
+
+    context_radius = 5
+
+    def segment_image(self, image):
+        padded = np.pad(image[:, :, 0].astype(np.int32), ((5, 5), (0, 0)), mode='edge')
+        window_sum = sum(padded[k:k + image.shape[0]] for k in range(11))
+        return (window_sum % 4 * 64 + 63).astype(np.uint8)
+
+
+def test_tile_bounds_cover_the_rows():
+    bounds = tile_bounds(1000, 300, 20)
+    assert [(top, bottom) for _, _, top, bottom in bounds] == [(0, 300), (300, 600), (600, 900), (900, 1000)]
+    assert bounds[1][:2] == (280, 620)
+
+
+def test_tiled_segmentation_identical_to_whole_leaf(tmp_path):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, size=(1000, 30, 3), dtype=np.uint8)
+    (tmp_path / 'in').mkdir()
+    cv2.imwrite(str(tmp_path / 'in' / '1_leaf1.png'), image)
+
+    whole = BlurBackend()
+    bounds = tile_bounds(1000, 128, 5)
+    tiled = stitch_tiles([whole.segment_image(image[start:stop]) for start, stop, _, _ in bounds], bounds)
+    assert np.array_equal(tiled, whole.segment_image(image))
+
+    (tmp_path / 'out').mkdir()
+    BlurBackend(tile_height=128, halo=5).segment_directory(str(tmp_path / 'in'), str(tmp_path / 'out'))
+    saved = cv2.imread(str(tmp_path / 'out' / '1_leaf1_Simple_Segmentation.png'), cv2.IMREAD_GRAYSCALE)
+    assert np.array_equal(saved, whole.segment_image(image))
+
+
+def test_tiled_segmentation_of_short_and_long_leaves(tmp_path):
+    rng = np.random.default_rng(1)
+    images = {f"1_leaf{k}.png": rng.integers(0, 256, size=(height, 30, 3), dtype=np.uint8)
+              for k, height in enumerate([50, 1000, 128, 90, 300], start=1)}
+    (tmp_path / 'in').mkdir()
+    (tmp_path / 'out').mkdir()
+    for filename, image in images.items():
+        cv2.imwrite(str(tmp_path / 'in' / filename), image)
+
+    BlurBackend(tile_height=128, halo=5).segment_directory(str(tmp_path / 'in'), str(tmp_path / 'out'))
+
+    whole = BlurBackend()
+    for filename, image in images.items():
+        saved = cv2.imread(str(tmp_path / 'out' / filename.replace('.png', '_Simple_Segmentation.png')), cv2.IMREAD_GRAYSCALE)
+        assert np.array_equal(saved, whole.segment_image(image)), filename
+
+
+@pytest.mark.parametrize('tile_height, halo', [(0, 5), (-128, 5), (128, 4), (128, -1)])
+def test_invalid_tiles_are_rejected(tile_height, halo):
+    with pytest.raises(ValueError):
+        BlurBackend(tile_height=tile_height, halo=halo)
+
+
+# Colors (BGR) of the background, healthy, oidium and rust pixels of the synthetic leaves
+CLASS_COLORS = [(250, 250, 250), (40, 140, 50), (200, 210, 200), (30, 90, 170)]
+
+
+def make_leaf(classes, seed):
+    """Make a leaf whose pixels have the color of their class (an index of CLASS_COLORS), plus noise."""
+    rng = np.random.default_rng(seed)
+    image = np.array(CLASS_COLORS, dtype=np.int16)[classes] + rng.integers(-8, 9, size=classes.shape + (3,))
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def test_pixel_classifier_recovers_the_classes(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    training_classes = rng.integers(0, len(CLASS_COLORS), size=(200, 200))
+    cv2.imwrite(str(tmp_path / 'image.png'), make_leaf(training_classes, seed=1))
+    cv2.imwrite(str(tmp_path / 'labels.png'), (training_classes + 1).astype(np.uint8))
+    train_pixel_classifier([str(tmp_path / 'image.png')], [str(tmp_path / 'labels.png')], str(tmp_path / 'model.npz'))
+
+    # A leaf of healthy tissue with blocks of lesions, on the background
+    classes = np.zeros((600, 120), dtype=np.intp)
+    classes[20:580, 10:110] = 1
+    classes[100:150, 30:60] = 2
+    classes[300:420, 50:90] = 3
+    (tmp_path / 'in').mkdir()
+    (tmp_path / 'out').mkdir()
+    cv2.imwrite(str(tmp_path / 'in' / '1_leaf1.png'), make_leaf(classes, seed=2))
+
+    backend = PixelClassifierBackend(str(tmp_path / 'model.npz'))
+    label_map = backend.segment_image(cv2.imread(str(tmp_path / 'in' / '1_leaf1.png')))
+    assert set(np.unique(label_map)) <= set(CLASS_VALUES)
+    assert np.array_equal(label_map, np.array(CLASS_VALUES, dtype=np.uint8)[classes])
+
+    # The features are computed by chunks of rows, whose size does not change the label map
+    monkeypatch.setattr(segmentation, 'CLASSIFICATION_CHUNK_SIZE', 7 * 120 + 1)
+    assert np.array_equal(backend.segment_image(cv2.imread(str(tmp_path / 'in' / '1_leaf1.png'))), label_map)
+
+    # The saved label map goes through the analysis of the leaves
+    backend.segment_directory(str(tmp_path / 'in'), str(tmp_path / 'out'))
+    background, leaf, healthy, oidium, rust = leaves_analysis(pd.DataFrame({'New_File_Name': ['1_leaf1.png']}),
+                                                               str(tmp_path / 'out'), 1)
+    counts = np.bincount(classes.reshape(-1), minlength=len(CLASS_VALUES))
+    assert (background[0], healthy[0], oidium[0], rust[0]) == tuple(counts)
+    assert leaf[0] == counts[1:].sum()
@@ -0,0 +1,133 @@
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from shared_images import CropExecutor
+from shared_images import SharedImagePool
+from shared_images import open_crop
+
+
+def save_crop(descriptor, path):
+    crop, shm = open_crop(descriptor)
+    np.save(path, crop)
+    del crop
+    shm.close()
+
+
+def save_crop_or_crash(descriptor, path):
+    if path.endswith('crash.npy'):
+        os._exit(1)
+    if path.endswith('error.npy'):
+        raise ValueError("cannot process the crop")
+    save_crop(descriptor, path)
+
+
+def make_image(height, width):
+    return np.arange(height * width * 3, dtype=np.uint32).reshape(height, width, 3).astype(np.uint8)
+
+
+def test_crops_are_read_from_the_shared_memory():
+    image = make_image(40, 30)
+    with SharedImagePool() as pool:
+        descriptors = pool.put(image, np.array([[0, 5, 10, 20], [15, 10, 40, 50]]))
+
+        crops = []
+        for descriptor in descriptors:
+            crop, shm = open_crop(descriptor)
+            crops.append(crop.copy())
+            del crop
+            shm.close()
+        assert np.array_equal(crops[0], image[5:20, 0:10])
+        assert np.array_equal(crops[1], image[10:40, 15:30]) # box clipped to the image
+
+        for descriptor in descriptors:
+            pool.release(descriptor.buffer_name)
+        assert pool.put(image, np.empty((0, 4))) == []
+
+
+def test_buffer_is_reused_once_all_its_crops_are_released():
+    with SharedImagePool(max_buffers=1) as pool:
+        descriptors = pool.put(make_image(40, 30), [[0, 0, 10, 10], [10, 10, 20, 20]])
+        name = descriptors[0].buffer_name
+
+        pool.release(name)
+        blocked_put = threading.Thread(target=pool.put, args=(make_image(20, 30), [[0, 0, 10, 20]]))
+        blocked_put.start()
+        blocked_put.join(0.3)
+        assert blocked_put.is_alive() # one crop of the first scan is still in use
+
+        pool.release(name)
+        blocked_put.join(5)
+        assert not blocked_put.is_alive()
+
+        # The crops of the second scan have reused the buffer of the first one
+        pool.release(name)
+        assert pool.put(make_image(40, 30), [[0, 0, 10, 10], [0, 0, 5, 10]])[0].buffer_name == name
+        pool.release(name)
+        pool.release(name)
+
+
+def test_too_small_buffer_is_replaced():
+    image = make_image(40, 30)
+    with SharedImagePool(max_buffers=1) as pool:
+        small = pool.put(image, [[0, 0, 10, 10]])[0].buffer_name
+        pool.release(small)
+
+        # Only the crops are copied, so the buffer is too small for larger crops of the same image
+        large = pool.put(image, [[0, 0, 30, 40]])[0].buffer_name
+        pool.release(large)
+
+        assert large != small
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=small)
+
+
+def test_close_while_buffers_are_in_use():
+    pool = SharedImagePool()
+    descriptors = pool.put(make_image(20, 30), [[0, 0, 10, 10]])
+
+    with pytest.raises(RuntimeError, match="1 shared buffers are still in use"):
+        pool.close()
+
+    pool.release(descriptors[0].buffer_name)
+    pool.close()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=descriptors[0].buffer_name)
+
+
+def test_crop_executor_errors_are_raised_by_settle(tmp_path):
+    image = make_image(40, 30)
+    boxes = [[0, 0, 10, 10], [10, 10, 30, 40]]
+
+    with CropExecutor(save_crop_or_crash, max_workers=2) as executor:
+        executor.submit(1, image, boxes, [(str(tmp_path / '1_a.npy'),), (str(tmp_path / '1_error.npy'),)])
+        executor.submit(2, image, boxes, [(str(tmp_path / '2_a.npy'),), (str(tmp_path / '2_b.npy'),)])
+
+        executor.settle(2)
+        with pytest.raises(ValueError, match="cannot process the crop"):
+            executor.settle(1)
+
+    assert sorted(os.listdir(tmp_path)) == ['1_a.npy', '2_a.npy', '2_b.npy']
+    assert np.array_equal(np.load(tmp_path / '2_b.npy'), image[10:40, 10:30])
+
+
+def test_crop_executor_replaces_a_dead_worker(tmp_path):
+    image = make_image(40, 30)
+    boxes = [[0, 0, 10, 10], [10, 10, 30, 40]]
+
+    with CropExecutor(save_crop_or_crash, max_workers=1, max_buffers=1) as executor:
+        # The worker process dies: the crops being processed fail, and their buffer is released
+        executor.submit(1, image, boxes, [(str(tmp_path / '1_crash.npy'),), (str(tmp_path / '1_b.npy'),)])
+        with pytest.raises(BrokenProcessPool):
+            executor.settle(1)
+
+        # The next crops are processed by new worker processes, the buffer being available again
+        executor.submit(2, image, boxes, [(str(tmp_path / '2_a.npy'),), (str(tmp_path / '2_b.npy'),)])
+        executor.settle(2)
+
+    assert np.array_equal(np.load(tmp_path / '2_a.npy'), image[0:10, 0:10])
+    assert np.array_equal(np.load(tmp_path / '2_b.npy'), image[10:40, 10:30])
@@ -0,0 +1,39 @@
+import numpy as np
+
+from conftest import RecordedReader
+from text_detection import get_number_from_groups
+from text_detection import group_detections
+from text_detection import remove_elements_starting_with
+from text_detection import sort_detections
+from text_detection import text_detection
+
+
+def _detections(case):
+    return [tuple(detection) for detection in case['detections']]
+
+
+def test_group_detections_golden(detection_cases):
+    for case in detection_cases:
+        groups = group_detections(sort_detections(_detections(case)), threshold=100)
+        assert [[detection[1] for detection in group] for group in groups] == case['groups'], case['name']
+
+
+def test_get_number_from_groups_golden(detection_cases):
+    for case in detection_cases:
+        detections = remove_elements_starting_with(sort_detections(_detections(case)), ['R', 'P'])
+        groups = group_detections(detections, threshold=100)
+        assert get_number_from_groups(groups, ['code', 'champ']) == case['expected']['code_champ'], case['name']
+        assert get_number_from_groups(groups, ['M']) == case['expected']['M'], case['name']
+        assert get_number_from_groups(groups, ['EPO']) == case['expected']['EPO'], case['name']
+
+
+def test_text_detection_golden(detection_cases):
+    image = np.full((1000, 400, 3), 255, dtype=np.uint8)
+    for case in detection_cases:
+        R, P, code_champ, M, EPO, snapshot = text_detection(image, reader=RecordedReader(case['detections']))
+        assert (R, P, code_champ, M, EPO) == tuple(case['expected'][key] for key in ('R', 'P', 'code_champ', 'M', 'EPO')), case['name']
+        assert snapshot.ndim == 2
+
+
+def test_text_detection_without_text():
+    assert text_detection(np.zeros((10, 10, 3), dtype=np.uint8), reader=RecordedReader([])) == (None,) * 6
@@ -0,0 +1,157 @@
+import os
+import subprocess
+import sys
+
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import FIXTURES
+from conftest import ROOT
+from conftest import make_scan
+from segmentation import train_pixel_classifier
+from utils import leaves_analysis
+from utils import lesions_analysis
+from utils import list_images
+from utils import merge_shards
+from utils import parse_shard
+from utils import setup_workspace
+
+PIXEL_AREA = 0.5
+
+
+def test_leaves_analysis_known_areas(segmented_leaves, label_map_cases):
+    segmented_leaves_path, results_dataframe = segmented_leaves
+
+    background, leaf, healthy, oidium, rust = leaves_analysis(results_dataframe, segmented_leaves_path, PIXEL_AREA)
+
+    for k, case in enumerate(label_map_cases):
+        pixels = {int(value): count for value, count in case['pixels'].items()}
+        assert background[k] == pixels[63] * PIXEL_AREA, case['name']
+        assert healthy[k] == pixels[127] * PIXEL_AREA, case['name']
+        assert oidium[k] == pixels[191] * PIXEL_AREA, case['name']
+        assert rust[k] == pixels[255] * PIXEL_AREA, case['name']
+        assert leaf[k] == (pixels[127] + pixels[191] + pixels[255]) * PIXEL_AREA, case['name']
+
+
+def test_lesions_analysis_matches_areas(segmented_leaves, label_map_cases):
+    segmented_leaves_path, results_dataframe = segmented_leaves
+
+    summary, lesions = lesions_analysis(results_dataframe, segmented_leaves_path, PIXEL_AREA, n_jobs=2)
+
+    for k, case in enumerate(label_map_cases):
+        name = results_dataframe['New_File_Name'][k]
+        for lesion_class, value in (('oidium', '191'), ('rust', '255')):
+            leaf_lesions = lesions[(lesions['New_File_Name'] == name) & (lesions['lesion_class'] == lesion_class)]
+            assert leaf_lesions['lesion_area'].sum() == case['pixels'][value] * PIXEL_AREA, case['name']
+            assert summary[f'{lesion_class}_lesion_count'][k] == len(leaf_lesions), case['name']
+
+
+def test_parse_shard():
+    assert parse_shard('1/4') == (1, 4)
+    with pytest.raises(ValueError):
+        parse_shard('4/4')
+
+
+def test_shards_partition_the_images(tmp_path):
+    for k in range(20):
+        (tmp_path / f"scan_{k}.jpg").touch()
+
+    shards = [list_images(str(tmp_path), (index, 3)) for index in range(3)]
+
+    assert sorted(sum(shards, [])) == list_images(str(tmp_path))
+
+
+def test_merge_shards_renumbers_labels(tmp_path):
+    for index, scans in enumerate([['b.jpg', 'c.jpg'], ['a.jpg']]):
+        results_path, file_path, _, labels_path = setup_workspace(str(tmp_path), f"Results_shard_{index}_of_2")
+        rows = []
+        for label, scan in enumerate(scans, start=1):
+            (tmp_path / labels_path / f"Labels_{label}.jpg").write_text(scan)
+            for leaf in (1, 2):
+                (tmp_path / file_path / f"{label}_leaf{leaf}.png").write_text(f"{scan} {leaf}")
+                rows.append({'Original_File_Name': scan, 'New_File_Name': f"{label}_leaf{leaf}.png",
+                             'Label': label, 'Label_Snapshot': f"Labels_{label}.jpg"})
+        pd.DataFrame(rows).to_csv(os.path.join(results_path, 'results.csv'), index=False)
+
+    results_path = merge_shards(str(tmp_path))
+
+    results = pd.read_csv(os.path.join(results_path, 'results.csv'))
+    assert results['Label'].tolist() == [1, 1, 2, 2, 3, 3]
+    assert results['Original_File_Name'].tolist() == ['a.jpg', 'a.jpg', 'b.jpg', 'b.jpg', 'c.jpg', 'c.jpg']
+    assert (tmp_path / results_path / 'File' / '3_leaf2.png').read_text() == 'c.jpg 2'
+    assert (tmp_path / results_path / 'Labels' / 'Labels_1.jpg').read_text() == 'a.jpg'
+
+
+# Run of the whole pipeline in a separate process, with the recorded OCR detections and the pixel classifier. The
+# script is also imported by the isolated worker processing the scans, which then uses the recorded detections too.
+RUN_SCRIPT = """
+import sys
+sys.path[:0] = [{root!r}, {tests!r}]
+import text_detection
+from conftest import RecordedReader, load_fixture
+text_detection.READER = RecordedReader(load_fixture('detections.json')[0]['detections'])
+
+if __name__ == '__main__':
+    from main import main
+    main({input_directory!r}, {output_directory!r}, model_path={model_path!r}, segmentation_backend='pixel',
+         shard={shard!r}, contact_sheet=True)
+"""
+
+
+def run_pipeline(input_directory, output_directory, model_path, shard=None):
+    script_path = f"{output_directory}_{'all' if shard is None else shard[0]}.py"
+    with open(script_path, 'w') as file:
+        file.write(RUN_SCRIPT.format(root=ROOT, tests=os.path.dirname(FIXTURES), input_directory=str(input_directory),
+                                     output_directory=str(output_directory), model_path=str(model_path), shard=shard))
+    return subprocess.Popen([sys.executable, script_path], stdout=subprocess.PIPE, text=True)
+
+
+def test_sharded_run_matches_single_run(tmp_path):
+    input_directory = tmp_path / 'input'
+    input_directory.mkdir()
+    scans = {
+        'a.jpg': [(200, 1000, 650, 7000)],
+        'b.jpg': [(100, 1000, 1300, 1800)],  # usable, but too short to be a leaf
+        'c.jpg': [(100, 1000, 550, 7000), (800, 1000, 1250, 7000)],
+        'd.jpg': [(200, 1000, 650, 7000)],
+    }
+    for k, (filename, leaves) in enumerate(scans.items()):
+        cv2.imwrite(str(input_directory / filename), make_scan(12000, 1400, leaves, seed=k))
+    cv2.imwrite(str(input_directory / 'e.jpg'), make_scan(500, 500, []))  # unusable
+
+    rng = np.random.default_rng(0)
+    cv2.imwrite(str(tmp_path / 'image.png'), rng.integers(0, 256, size=(100, 100, 3), dtype=np.uint8))
+    cv2.imwrite(str(tmp_path / 'labels.png'), rng.integers(0, 5, size=(100, 100), dtype=np.uint8))
+    model_path = tmp_path / 'model.npz'
+    train_pixel_classifier([str(tmp_path / 'image.png')], [str(tmp_path / 'labels.png')], str(model_path))
+
+    # Run the shards as separate processes, alongside the single run
+    processes = [run_pipeline(input_directory, tmp_path / 'single', model_path)]
+    processes += [run_pipeline(input_directory, tmp_path / 'sharded', model_path, (index, 2)) for index in range(2)]
+    outputs = [process.communicate()[0] for process in processes]
+    assert [process.returncode for process in processes] == [0, 0, 0]
+
+    # The images written by the isolated worker are counted: 4 leaves, 3 label snapshots and a contact sheet
+    assert "Images written: 8 " in outputs[0]
+    assert all(os.listdir(tmp_path / 'sharded' / f"Results_shard_{index}_of_2" / 'File') for index in range(2))
+
+    single_path = tmp_path / 'single' / 'Results'
+    merged_path = merge_shards(str(tmp_path / 'sharded'))
+
+    single = pd.read_csv(single_path / 'results.csv')
+    merged = pd.read_csv(os.path.join(merged_path, 'results.csv'))
+    pd.testing.assert_frame_equal(merged, single)
+    assert single['Label'].tolist() == [1, 2, 2, 3]
+
+    for directory in ('File', 'segmented_leaves'):
+        names = sorted(os.listdir(single_path / directory))
+        assert sorted(os.listdir(os.path.join(merged_path, directory))) == names
+        for name in names:
+            assert np.array_equal(cv2.imread(os.path.join(merged_path, directory, name), cv2.IMREAD_UNCHANGED),
+                                  cv2.imread(str(single_path / directory / name), cv2.IMREAD_UNCHANGED)), name
+
+    assert sorted(os.listdir(os.path.join(merged_path, 'Labels'))) == sorted(os.listdir(single_path / 'Labels')) == [
+        'Labels_1.jpg', 'Labels_2.jpg', 'Labels_3.jpg', 'Labels_contact_sheet_1.jpg']
+    assert sorted(os.listdir(os.path.join(merged_path, 'Unusable_File'))) == ['Unusable_File_e.jpg']
@@ -15,7 +15,6 @@ import re
 
 import numpy as np
 import cv2
-import easyocr
 
 ########################################################################################################
 ############################           Parameters & Constants              #############################
@@ -24,8 +23,10 @@ import easyocr
 # Constants
 TRESHOLD = 100
 COMPRESSION_RATIO = 0.9
+TEXT_MARGIN = 50 # margin in pixels added around the text localised on a reduced-resolution image
 
-READER = easyocr.Reader(['en'], gpu=True)
+# The OCR reader is created on first use, so that the module can be imported without loading the OCR models
+READER = None
 
 ########################################################################################################
 ############################                 Main Functions                 #############################
@@ -33,7 +34,7 @@ READER = easyocr.Reader(['en'], gpu=True)
 
 
 def text_detection(img: np.ndarray,
-                   reader: easyocr.Reader = READER,
+                   reader: 'easyocr.Reader' = None,
                    threshold: int = 100,
                    compression_ratio: float = 0.9) -> tuple:
     """
@@ -41,20 +42,20 @@ def text_detection(img: np.ndarray,
 
     Parameters:
         - img (numpy.ndarray): The image to process.
-        - reader (easyocr.Reader): The OCR reader to use for text detection.
+        - reader (easyocr.Reader, optional): The OCR reader to use for text detection. Default is the reader of `get_reader`.
         - threshold (int, optional): The threshold to use for grouping detections. Default is 100.
 
     Returns:
-        - tuple: A tuple containing the values of R, P, code_champ, M, EPO.
+        - tuple: A tuple containing the values of R, P, code_champ, M, EPO and the label snapshot
+                 (None if no text is detected).
     """
 
     # Use the OCR reader to detect text in the image
-    detections = reader.readtext(img)
+    detections = (reader or get_reader()).readtext(img)
 
-    # If no text is detected, return None for all values and an empty image
+    # If no text is detected, return None for all values and no label snapshot
     if not detections:
-        empty_image = np.zeros_like(img)
-        return None, None, None, None, None, empty_image
+        return None, None, None, None, None, None
     
     # Create a text box around the detected text and compress it according to the specified ratio
     text_box_result = text_box(img, detections, compression_ratio)
@@ -84,6 +85,61 @@ def text_detection(img: np.ndarray,
 
     return R, P, code_champ, M, EPO, text_box_result
 
+
+def locate_text(reduced_img: np.ndarray,
+                reduction: int,
+                reader: 'easyocr.Reader' = None,
+                margin: int = TEXT_MARGIN) -> tuple:
+    """
+    Localise the text of a scan on a reduced-resolution version of it, without recognising it.
+
+    Only the text detector of the OCR reader is run, so that the recognition can then be run with
+    `text_detection` on the full-resolution crop of the region containing the text.
+
+    Parameters:
+        - reduced_img (numpy.ndarray): The reduced-resolution image.
+        - reduction (int): The reduction factor of the image with respect to the full-resolution scan.
+        - reader (easyocr.Reader, optional): The OCR reader to use for text detection. Default is the reader of `get_reader`.
+        - margin (int, optional): The margin in full-resolution pixels added around the text. Default is TEXT_MARGIN.
+
+    Returns:
+        - tuple: The bounding box (x_min, y_min, x_max, y_max) of the text in full-resolution coordinates,
+                 or None if no text is detected.
+    """
+    horizontal_list, free_list = (reader or get_reader()).detect(reduced_img)
+
+    # Horizontal boxes are given as [x_min, x_max, y_min, y_max], free boxes as a list of 4 points
+    boxes = [(x_min, y_min, x_max, y_max) for x_min, x_max, y_min, y_max in horizontal_list[0]]
+    for points in free_list[0]:
+        xs, ys = [point[0] for point in points], [point[1] for point in points]
+        boxes.append((min(xs), min(ys), max(xs), max(ys)))
+
+    if not boxes:
+        return None
+
+    x_min = max(0, int(min(box[0] for box in boxes) * reduction) - margin)
+    y_min = max(0, int(min(box[1] for box in boxes) * reduction) - margin)
+    x_max = int(max(box[2] for box in boxes) * reduction) + margin
+    y_max = int(max(box[3] for box in boxes) * reduction) + margin
+
+    return x_min, y_min, x_max, y_max
+
+
+def get_reader() -> 'easyocr.Reader':
+    """
+    Returns the OCR reader shared by the functions of this module, creating it on first use.
+
+    Returns:
+        - easyocr.Reader: The OCR reader.
+    """
+    global READER
+
+    if READER is None:
+        import easyocr
+        READER = easyocr.Reader(['en'], gpu=True)
+
+    return READER
+
 ########################################################################################################
 ############################           Helper Functions                    #############################
 ########################################################################################################
@@ -11,13 +11,29 @@ Authors: LE GOURRIEREC Titouan, CONNESSON Léna, PROUVOST Axel
 Date: 04/06/2024
 """
 
+import hashlib
+import multiprocessing
 import os
+import re
+import shutil
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import cv2
 import pandas as pd
 import numpy as np
 
+from fault_isolation import DEAD_LETTER_DIR
+from fault_isolation import ERRORS_FILE
+
+from image_writer import ImageWriter
+
+from label_snapshots import LabelSnapshotWriter
+from label_snapshots import CONTACT_SHEET_NAME
+
+from shared_images import CropDescriptor
+from shared_images import open_crop
+
 ########################################################################################################
 ############################           Parameters & Constants              #############################
 ########################################################################################################
@@ -27,14 +43,44 @@ NEW_RESULTS_DIR = 'Results'
 FILE_DIR = 'File'
 UNUSABLE_FILE_DIR = 'Unusable_File'
 LABELS_DIR = 'Labels'
+SEGMENTED_LEAVES_DIR = 'segmented_leaves'
+COLOR_SPACE_DIR = 'color_space'
+RESULTS_FILE = 'results.csv'
+UNUSABLE_FILES_FILE = 'unusable_files.csv'
+
+# Name of the results directory of a shard, e.g. 'Results_shard_0_of_4'
+SHARD_RESULTS_DIR = NEW_RESULTS_DIR + '_shard_{index}_of_{count}'
+SHARD_RESULTS_PATTERN = re.compile(NEW_RESULTS_DIR + r'_shard_(\d+)_of_(\d+)')
 
 IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
 
+# Mapping from color space names to OpenCV conversion flags
+COLOR_SPACE_CONVERSIONS = {
+    'YUV': cv2.COLOR_BGR2YUV,
+    'HSV': cv2.COLOR_BGR2HSV,
+    'LAB': cv2.COLOR_BGR2LAB,
+    'HLS': cv2.COLOR_BGR2HLS,
+}
+
+# Grey levels of the classes in the segmentation masks
+BACKGROUND_VALUE = 63
+HEALTHY_VALUE = 127
+OIDIUM_VALUE = 191
+RUST_VALUE = 255
+LESION_CLASSES = {'oidium': OIDIUM_VALUE, 'rust': RUST_VALUE}
+
+# Lesion analysis parameters
+LESIONS_FILE = 'lesions.csv'
+MIN_LESION_PIXELS = 5       # components smaller than this are considered as noise
+LESION_CONNECTIVITY = 8
+LESION_CHUNKSIZE = 8        # number of masks sent at once to each worker
+
 ########################################################################################################
 ############################                 Main Functions                 #############################
 ########################################################################################################
 
-def setup_workspace(output_directory: str) -> tuple:
+def setup_workspace(output_directory: str,
+                    results_dir: str = NEW_RESULTS_DIR) -> tuple:
     """
     Sets up the workspace for the image processing task.
 
@@ -43,13 +89,14 @@ def setup_workspace(output_directory: str) -> tuple:
 
     Parameters:
         - output_directory (str): The path to the directory where the results should be stored.
+        - results_dir (str, optional): The name of the results directory. Defaults to NEW_RESULTS_DIR.
 
     Returns:
         - tuple: A tuple containing the paths to the results directory, the processed images directory, 
         - the unusable images directory, and the labels directory.
     """
     # Create a new directory for the results
-    results_path = os.path.join(output_directory, NEW_RESULTS_DIR)
+    results_path = os.path.join(output_directory, results_dir)
     os.makedirs(results_path, exist_ok=True)
 
     # Create subdirectories for the processed and unusable images and the labels
@@ -63,6 +110,209 @@ def setup_workspace(output_directory: str) -> tuple:
     return results_path, file_path, unusable_file_path, labels_path
 
 
+def list_images(input_directory: str,
+                shard: tuple = None) -> list[str]:
+    """
+    Lists the image files of a directory, sorted by name.
+
+    When a shard (index, count) is given, only the files assigned to this shard are returned. A file is assigned
+    to the shard `sha1(filename) % count`, so the assignment only depends on the file name and not on the
+    other files of the directory or on the node processing it.
+
+    Parameters:
+        - input_directory (str): The directory where the input images are located.
+        - shard (tuple, optional): The index and the number of shards. Defaults to None (all the files).
+
+    Returns:
+        - list: The sorted list of the image file names.
+    """
+    filenames = sorted(filename for filename in os.listdir(input_directory)
+                       if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS)
+
+    if shard is not None:
+        index, count = shard
+        filenames = [filename for filename in filenames if _shard_of(filename, count) == index]
+
+    return filenames
+
+
+def _shard_of(filename: str, count: int) -> int:
+    """Return the shard of a file name, among `count` shards."""
+    digest = hashlib.sha1(filename.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def parse_shard(shard: str) -> tuple:
+    """
+    Parses a shard given as 'i/N' into the tuple (i, N), with 0 <= i < N.
+
+    Parameters:
+        - shard (str): The shard, e.g. '0/4'.
+
+    Returns:
+        - tuple: The index and the number of shards.
+    """
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', shard)
+    if match is None:
+        raise ValueError(f"Invalid shard '{shard}', expected 'i/N'.")
+
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard '{shard}', expected 0 <= i < N.")
+
+    return index, count
+
+
+def merge_shards(output_directory: str) -> str:
+    """
+    Merges the results of the shards saved in the output directory into a single results directory.
+
+    The rows of all the shards are sorted by original file name and leaf number, then the labels are renumbered
+    from 1 in this order. The leaves, segmented leaves, labels and unusable files are copied to the merged
+    results directory under their new names, so the merge gives the same output whatever the number of shards.
+    If the shards have contact sheets, they are rebuilt from the merged label snapshots.
+
+    Parameters:
+        - output_directory (str): The directory containing the results directories of the shards.
+
+    Returns:
+        - str: The path to the merged results directory.
+    """
+    # Find the results directories of the shards
+    shard_paths = {}
+    counts = set()
+    for name in os.listdir(output_directory):
+        match = SHARD_RESULTS_PATTERN.fullmatch(name)
+        if match and os.path.isdir(os.path.join(output_directory, name)):
+            shard_paths[int(match.group(1))] = os.path.join(output_directory, name)
+            counts.add(int(match.group(2)))
+
+    if len(counts) != 1:
+        raise ValueError(f"Expected the shards of a single run in {output_directory}, found shard counts {sorted(counts)}.")
+    count = counts.pop()
+    missing = sorted(set(range(count)) - set(shard_paths))
+    if missing:
+        raise FileNotFoundError(f"Missing the results of the shards {missing} of {count}.")
+
+    # Read the results of the shards
+    results = []
+    lesions = []
+    for index in range(count):
+        shard_results = pd.read_csv(os.path.join(shard_paths[index], RESULTS_FILE))
+        shard_results['Shard'] = index
+        results.append(shard_results)
+
+        lesions_path = os.path.join(shard_paths[index], LESIONS_FILE)
+        if os.path.exists(lesions_path):
+            shard_lesions = pd.read_csv(lesions_path)
+            shard_lesions['Shard'] = index
+            lesions.append(shard_lesions)
+
+    results_dataframe = pd.concat(results, ignore_index=True)
+
+    # Sort the leaves and renumber the labels and the new file names
+    results_dataframe['Leaf_Index'] = [int(re.search(r'_leaf(\d+)', name).group(1)) for name in results_dataframe['New_File_Name']]
+    results_dataframe = results_dataframe.sort_values(['Original_File_Name', 'Leaf_Index'], kind='stable', ignore_index=True)
+
+    new_labels = {name: i + 1 for i, name in enumerate(results_dataframe['Original_File_Name'].unique())}
+    old_file_names = results_dataframe['New_File_Name'].copy()
+    old_labels = results_dataframe['Label'].copy()
+    results_dataframe['Label'] = results_dataframe['Original_File_Name'].map(new_labels)
+    results_dataframe['New_File_Name'] = [f"{label}_leaf{leaf_index}.png" for label, leaf_index
+                                          in zip(results_dataframe['Label'], results_dataframe['Leaf_Index'])]
+
+    # Copy the files of the shards under their new names
+    results_path, file_path, unusable_file_path, labels_path = setup_workspace(output_directory)
+    segmented_leaves_path = os.path.join(results_path, SEGMENTED_LEAVES_DIR)
+    os.makedirs(segmented_leaves_path, exist_ok=True)
+
+    for shard, old_name, new_name in zip(results_dataframe['Shard'], old_file_names, results_dataframe['New_File_Name']):
+        shard_path = shard_paths[shard]
+        shutil.copy2(os.path.join(shard_path, FILE_DIR, old_name), os.path.join(file_path, new_name))
+
+        old_segmented = os.path.join(shard_path, SEGMENTED_LEAVES_DIR, os.path.splitext(old_name)[0] + '_Simple_Segmentation.png')
+        if os.path.exists(old_segmented):
+            shutil.copy2(old_segmented, os.path.join(segmented_leaves_path, os.path.splitext(new_name)[0] + '_Simple_Segmentation.png'))
+
+    if 'Label_Snapshot' in results_dataframe:
+        old_snapshots = results_dataframe['Label_Snapshot'].fillna('')
+    else:
+        old_snapshots = [f"Labels_{old_label}.jpg" for old_label in old_labels]
+
+    new_snapshots = []
+    for shard, old_snapshot, new_label in zip(results_dataframe['Shard'], old_snapshots, results_dataframe['Label']):
+        old_snapshot_path = os.path.join(shard_paths[shard], LABELS_DIR, old_snapshot)
+        if old_snapshot and os.path.exists(old_snapshot_path):
+            new_snapshot = f"Labels_{new_label}{os.path.splitext(old_snapshot)[1]}"
+            shutil.copy2(old_snapshot_path, os.path.join(labels_path, new_snapshot))
+        else:
+            new_snapshot = ''
+        new_snapshots.append(new_snapshot)
+
+    if 'Label_Snapshot' in results_dataframe:
+        results_dataframe['Label_Snapshot'] = new_snapshots
+
+    # Rebuild the contact sheets with the new labels
+    sheet_formats = sorted({os.path.splitext(name)[1] for index in range(count)
+                            for name in os.listdir(os.path.join(shard_paths[index], LABELS_DIR))
+                            if name.startswith(CONTACT_SHEET_NAME.format(index=''))})
+    if sheet_formats:
+        image_writer = ImageWriter()
+        label_writer = LabelSnapshotWriter(image_writer, labels_path, sheet_formats[0], contact_sheet=True)
+        for new_label, new_snapshot in dict(zip(results_dataframe['Label'], new_snapshots)).items():
+            if new_snapshot:
+                label_writer.add_to_contact_sheet(new_label, cv2.imread(os.path.join(labels_path, new_snapshot)))
+        label_writer.close()
+        image_writer.close()
+
+    for index in range(count):
+        shard_unusable_path = os.path.join(shard_paths[index], UNUSABLE_FILE_DIR)
+        for filename in sorted(os.listdir(shard_unusable_path)):
+            shutil.copy2(os.path.join(shard_unusable_path, filename), os.path.join(unusable_file_path, filename))
+
+    unusable_files = [pd.read_csv(os.path.join(shard_paths[index], UNUSABLE_FILES_FILE)) for index in range(count)
+                      if os.path.exists(os.path.join(shard_paths[index], UNUSABLE_FILES_FILE))]
+    if unusable_files:
+        unusable_dataframe = pd.concat(unusable_files, ignore_index=True)
+        unusable_dataframe = unusable_dataframe.sort_values('Original_File_Name', kind='stable', ignore_index=True)
+        unusable_dataframe.to_csv(os.path.join(results_path, UNUSABLE_FILES_FILE), index=False)
+
+    errors = []
+    for index in range(count):
+        errors_path = os.path.join(shard_paths[index], ERRORS_FILE)
+        if os.path.exists(errors_path):
+            errors.append(pd.read_csv(errors_path))
+
+        shard_dead_letter_path = os.path.join(shard_paths[index], DEAD_LETTER_DIR)
+        if os.path.isdir(shard_dead_letter_path):
+            os.makedirs(os.path.join(results_path, DEAD_LETTER_DIR), exist_ok=True)
+            for filename in sorted(os.listdir(shard_dead_letter_path)):
+                shutil.copy2(os.path.join(shard_dead_letter_path, filename), os.path.join(results_path, DEAD_LETTER_DIR, filename))
+
+    if errors:
+        errors_dataframe = pd.concat(errors, ignore_index=True)
+        errors_dataframe = errors_dataframe.sort_values(['Original_File_Name', 'Attempt'], kind='stable', ignore_index=True)
+        errors_dataframe.to_csv(os.path.join(results_path, ERRORS_FILE), index=False)
+
+    # Rename the leaves of the per-lesion table
+    if lesions:
+        renaming = {(shard, old_name): new_name for shard, old_name, new_name
+                    in zip(results_dataframe['Shard'], old_file_names, results_dataframe['New_File_Name'])}
+        lesions_dataframe = pd.concat(lesions, ignore_index=True)
+        lesions_dataframe['New_File_Name'] = [renaming[key] for key in zip(lesions_dataframe['Shard'], lesions_dataframe['New_File_Name'])]
+        lesions_dataframe = lesions_dataframe.drop(columns='Shard')
+        order = {name: i for i, name in enumerate(results_dataframe['New_File_Name'])}
+        lesions_dataframe = lesions_dataframe.sort_values(['New_File_Name', 'lesion_class', 'lesion_id'],
+                                                          key=lambda column: column.map(order) if column.name == 'New_File_Name' else column,
+                                                          kind='stable', ignore_index=True)
+        lesions_dataframe.to_csv(os.path.join(results_path, LESIONS_FILE), index=False)
+
+    results_dataframe = results_dataframe.drop(columns=['Shard', 'Leaf_Index'])
+    results_dataframe.to_csv(os.path.join(results_path, RESULTS_FILE), index=False)
+
+    return results_path
+
+
 def convert_color_space(input_directory: str,
                      output_directory: str,
                      color_space: str) -> str:
@@ -78,14 +328,6 @@ def convert_color_space(input_directory: str,
         - str: The path to the directory containing the converted images.
     """
     
-    # Mapping from color space names to OpenCV conversion flags
-    conversion_flags = {
-        'YUV': cv2.COLOR_BGR2YUV,
-        'HSV': cv2.COLOR_BGR2HSV,
-        'LAB': cv2.COLOR_BGR2LAB,
-        'HLS': cv2.COLOR_BGR2HLS,
-    }
-
     for filename in os.listdir(input_directory):
         if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
             
@@ -93,10 +335,10 @@ def convert_color_space(input_directory: str,
             img = cv2.imread(os.path.join(input_directory, filename))
 
             # Convert the color space of the image
-            converted_img = cv2.cvtColor(img, conversion_flags[color_space])
+            converted_img = cv2.cvtColor(img, COLOR_SPACE_CONVERSIONS[color_space])
             
             # Create the output subdirectory if it doesn't exist
-            output_subdir = os.path.join(output_directory, 'color_space')
+            output_subdir = os.path.join(output_directory, COLOR_SPACE_DIR)
             if not os.path.exists(output_subdir):
                 os.makedirs(output_subdir)
 
@@ -109,6 +351,29 @@ def convert_color_space(input_directory: str,
     return output_subdir
 
 
+def convert_crop_color_space(descriptor: CropDescriptor,
+                             output_path: str,
+                             color_space: str) -> None:
+    """
+    Converts the color space of a leaf crop held in shared memory and saves it, in a worker process.
+
+    Parameters:
+        - descriptor (CropDescriptor): The descriptor of the crop in the shared buffer of its scan.
+        - output_path (str): The path where the converted crop should be saved.
+        - color_space (str): The target color space. Supported values are 'YUV', 'HSV', 'LAB', and 'HLS'.
+    """
+    crop, shm = open_crop(descriptor)
+    try:
+        converted_img = cv2.cvtColor(crop, COLOR_SPACE_CONVERSIONS[color_space])
+    finally:
+        # The view must be deleted before detaching from the shared memory
+        del crop
+        shm.close()
+
+    if not cv2.imwrite(output_path, converted_img):
+        raise IOError(f"Could not write the image {output_path}.")
+
+
 def leaves_analysis(results_dataframe: pd.DataFrame,
                     segmented_leaves_path: str,
                     PIXEL_AREA: float) -> tuple:
@@ -149,6 +414,125 @@ def leaves_analysis(results_dataframe: pd.DataFrame,
 
     return background_list, leaf_list, healthy_leaf_list, oidium_leaf_list, rust_leaf_list
 
+
+def lesions_analysis(results_dataframe: pd.DataFrame,
+                     segmented_leaves_path: str,
+                     PIXEL_AREA: float,
+                     n_jobs: int = None) -> tuple:
+    """
+    Computes the lesion statistics of every segmented leaf, in parallel.
+
+    The masks are distributed in batches of LESION_CHUNKSIZE to a pool of processes, each mask being labelled
+    in a single connected-components pass (see `lesion_statistics`).
+
+    Parameters:
+        - results_dataframe (pandas.DataFrame): The dataframe containing the results.
+        - segmented_leaves_path (str): The path to the directory containing the segmented leaves images.
+        - PIXEL_AREA (float): The area represented by each pixel.
+        - n_jobs (int, optional): The number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        - tuple: A dataframe with the per-leaf lesion summary (one row per row of `results_dataframe`)
+                 and a dataframe with one row per lesion.
+    """
+    paths = [os.path.join(segmented_leaves_path, os.path.splitext(elt)[0] + '_Simple_Segmentation.png')
+             for elt in results_dataframe["New_File_Name"]]
+
+    # The workers are spawned rather than forked: forking while the threads of the image writer or of the OCR
+    # libraries run could deadlock them
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('spawn')) as executor:
+        per_leaf_lesions = list(executor.map(lesion_statistics, paths,
+                                             [PIXEL_AREA] * len(paths),
+                                             chunksize=LESION_CHUNKSIZE))
+
+    summary_rows = []
+    lesion_rows = []
+    for new_file_name, lesions in zip(results_dataframe["New_File_Name"], per_leaf_lesions):
+        summary = {}
+        for lesion_class in LESION_CLASSES:
+            areas = [lesion['lesion_area'] for lesion in lesions if lesion['lesion_class'] == lesion_class]
+            summary[f'{lesion_class}_lesion_count'] = len(areas)
+            summary[f'{lesion_class}_mean_lesion_area'] = round(float(np.mean(areas)), 3) if areas else 0.0
+            summary[f'{lesion_class}_median_lesion_area'] = round(float(np.median(areas)), 3) if areas else 0.0
+            summary[f'{lesion_class}_max_lesion_area'] = max(areas) if areas else 0.0
+        summary_rows.append(summary)
+        lesion_rows.extend({'New_File_Name': new_file_name, **lesion} for lesion in lesions)
+
+    summary_dataframe = pd.DataFrame(summary_rows, index=results_dataframe.index)
+    lesions_dataframe = pd.DataFrame(lesion_rows, columns=['New_File_Name', 'lesion_class', 'lesion_id',
+                                                           'lesion_area', 'x', 'y', 'width', 'height',
+                                                           'centroid_x', 'centroid_y', 'relative_position'])
+
+    return summary_dataframe, lesions_dataframe
+
+
+def lesion_statistics(mask_path: str,
+                      PIXEL_AREA: float,
+                      min_lesion_pixels: int = MIN_LESION_PIXELS,
+                      connectivity: int = LESION_CONNECTIVITY) -> list[dict]:
+    """
+    Extracts the lesions of one segmentation mask with a single connected-components pass.
+
+    The binary masks of the lesion classes are stacked vertically, separated by an empty row so that
+    components of different classes can never touch, and labelled at once with
+    `cv2.connectedComponentsWithStats`. The class of each component is then given by its vertical position.
+
+    Parameters:
+        - mask_path (str): The path to the segmentation mask.
+        - PIXEL_AREA (float): The area represented by each pixel.
+        - min_lesion_pixels (int, optional): The minimum number of pixels of a lesion. Defaults to MIN_LESION_PIXELS.
+        - connectivity (int, optional): The connectivity used for the labelling (4 or 8). Defaults to LESION_CONNECTIVITY.
+
+    Returns:
+        - list: A list of dictionaries, one per lesion, with its class, area, bounding box, centroid and
+                relative position along the leaf (0 at the top of the leaf, 1 at the bottom).
+    """
+    mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+    height, width = mask.shape
+
+    # Stack the binary masks of the lesion classes, separated by an empty row
+    stride = height + 1
+    stacked = np.zeros((len(LESION_CLASSES) * stride, width), dtype=np.uint8)
+    for k, value in enumerate(LESION_CLASSES.values()):
+        stacked[k * stride:k * stride + height] = mask == value
+
+    n_labels, _, stats, centroids = cv2.connectedComponentsWithStats(stacked, connectivity=connectivity)
+
+    # Vertical extent of the leaf, used to express the position of the lesions along the leaf
+    leaf_rows = np.flatnonzero((mask != BACKGROUND_VALUE).any(axis=1))
+    leaf_top, leaf_length = (leaf_rows[0], max(leaf_rows[-1] - leaf_rows[0], 1)) if leaf_rows.size else (0, max(height - 1, 1))
+
+    class_names = list(LESION_CLASSES)
+    lesion_ids = dict.fromkeys(class_names, 0)
+    lesions = []
+
+    # Label 0 is the background of the stacked image
+    for label in range(1, n_labels):
+        x, y, w, h, area = stats[label]
+        if area < min_lesion_pixels:
+            continue
+        k = y // stride
+        y -= k * stride
+        centroid_x, centroid_y = centroids[label][0], centroids[label][1] - k * stride
+
+        lesion_class = class_names[k]
+        lesion_ids[lesion_class] += 1
+        lesions.append({
+            'lesion_class': lesion_class,
+            'lesion_id': lesion_ids[lesion_class],
+            'lesion_area': round(int(area) * PIXEL_AREA, 3),
+            'x': int(x),
+            'y': int(y),
+            'width': int(w),
+            'height': int(h),
+            'centroid_x': round(float(centroid_x), 1),
+            'centroid_y': round(float(centroid_y), 1),
+            'relative_position': round(float(np.clip((centroid_y - leaf_top) / leaf_length, 0, 1)), 3),
+        })
+
+    return lesions
+
+
 def status_update(update_status: callable, 
                   message: str) -> float:
     """Update the status of the process."""